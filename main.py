@@ -7,8 +7,25 @@ Yandex Music Player для Arch Linux
 import sys
 import os
 import json
+import argparse
+import base64
+import hashlib
+import contextvars
+import random
+import signal
+import re
+import struct
 import threading
 import time
+import unicodedata
+import urllib.request
+import zlib
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode, urlsplit
+from contextlib import contextmanager
+from enum import IntEnum
 from typing import Optional, List, Dict, Any
 from pathlib import Path
 import logging
@@ -20,6 +37,7 @@ try:
     from PyQt5.QtGui import *
     from PyQt5.QtMultimedia import *
     from PyQt5.QtMultimediaWidgets import *
+    from PyQt5.QtNetwork import *
 except ImportError:
     print("Установите PyQt5: sudo pacman -S python-pyqt5")
     sys.exit(1)
@@ -27,6 +45,7 @@ except ImportError:
 # Yandex Music API
 try:
     from yandex_music import Client, Track, Playlist
+    from yandex_music.exceptions import NetworkError as YandexNetworkError
 except ImportError:
     print("Установите yandex-music: pip install yandex-music")
     sys.exit(1)
@@ -35,14 +54,22 @@ except ImportError:
 try:
     import spotipy
     from spotipy.oauth2 import SpotifyOAuth, SpotifyClientCredentials
-    from types import SimpleNamespace
 except ImportError:
     spotipy = None  # Будем проверять при попытке использования
 
+# NumPy (кроссфейд, сопоставление треков)
+try:
+    import numpy as np
+except ImportError:
+    np = None  # Будем проверять при попытке использования
+
 # Настройка логирования  
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Каталог для кэшей и служебных файлов плеера
+CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "yandex-music-player"
+
 # ======= Абстракция для разных музыкальных сервисов =======
 
 class AbstractMusicAPI:
@@ -72,6 +99,23 @@ class AbstractMusicAPI:
     def download_track(self, track, path: str) -> bool:
         return False
 
+    def get_tracks_by_ids(self, ids):
+        """Получить треки по идентификаторам одним запросом"""
+        return []
+
+    # Поддерживает ли сервис ревизии коллекций (get_liked_track_ids и др.)
+    supports_revisions = False
+
+    # Устанавливается планировщиком запросов: вызывается с паузой в секундах при 429
+    on_rate_limited = None
+
+    def report_error(self, message: str, error: Exception):
+        """Залогировать ошибку запроса; превышение лимита передать планировщику"""
+        logger.error(f"{message}: {error}")
+        retry_after = retry_after_from_error(error)
+        if retry_after is not None and self.on_rate_limited is not None:
+            self.on_rate_limited(retry_after)
+
 class StubMusicAPI(AbstractMusicAPI):
     """Заглушка для сервисов, которые пока не реализованы."""
 
@@ -84,6 +128,8 @@ class StubMusicAPI(AbstractMusicAPI):
 class YandexMusicAPI(AbstractMusicAPI):
     """Обертка для работы с Yandex Music API"""
     
+    supports_revisions = True
+    
     def __init__(self, token: Optional[str] = None):
         self.client = None
         self.token = token
@@ -98,7 +144,7 @@ class YandexMusicAPI(AbstractMusicAPI):
             logger.info(f"Авторизован как: {self.current_user.account.display_name}")
             return True
         except Exception as e:
-            logger.error(f"Ошибка авторизации: {e}")
+            self.report_error("Ошибка авторизации", e)
             return False
     
     def get_my_wave(self) -> List[Track]:
@@ -111,7 +157,7 @@ class YandexMusicAPI(AbstractMusicAPI):
             dashboard = self.client.rotor_stations_dashboard()
             return dashboard.stations[0].get_tracks()
         except Exception as e:
-            logger.error(f"Ошибка получения Моей Волны: {e}")
+            self.report_error("Ошибка получения Моей Волны", e)
             return []
     
     def get_liked_tracks(self) -> List[Track]:
@@ -121,7 +167,7 @@ class YandexMusicAPI(AbstractMusicAPI):
         try:
             return self.client.users_likes_tracks()
         except Exception as e:
-            logger.error(f"Ошибка получения понравившихся треков: {e}")
+            self.report_error("Ошибка получения понравившихся треков", e)
             return []
     
     def get_playlists(self) -> List[Playlist]:
@@ -131,7 +177,7 @@ class YandexMusicAPI(AbstractMusicAPI):
         try:
             return self.client.users_playlists_list()
         except Exception as e:
-            logger.error(f"Ошибка получения плейлистов: {e}")
+            self.report_error("Ошибка получения плейлистов", e)
             return []
     
     def search(self, query: str, type_: str = 'track') -> List:
@@ -148,16 +194,57 @@ class YandexMusicAPI(AbstractMusicAPI):
                 return result.artists.results if result.artists else []
             return []
         except Exception as e:
-            logger.error(f"Ошибка поиска: {e}")
+            self.report_error("Ошибка поиска", e)
+            return []
+    
+    def get_tracks_by_ids(self, ids) -> List[Track]:
+        """Получить треки по идентификаторам"""
+        if not self.client or not ids:
+            return []
+        try:
+            return self.client.tracks(ids)
+        except Exception as e:
+            self.report_error("Ошибка получения треков", e)
             return []
     
+    # ---- Ревизии коллекций (дельта-синхронизация) ----
+    
+    def get_liked_track_ids(self, since_revision: int = 0):
+        """(ревизия, [id]) понравившихся треков или None, если с since_revision
+        ничего не изменилось. Без изменений сервер отвечает пустой библиотекой."""
+        if not self.client:
+            return None
+        try:
+            likes = self.client.users_likes_tracks(if_modified_since_revision=since_revision)
+            if likes is None or (since_revision and likes.revision <= since_revision):
+                return None
+            return likes.revision, [str(t.id) for t in likes.tracks]
+        except Exception as e:
+            self.report_error("Ошибка синхронизации понравившихся", e)
+            return None
+    
+    def get_playlist_revisions(self) -> Dict[str, int]:
+        """{kind плейлиста: ревизия} для всех плейлистов пользователя"""
+        return {str(p.kind): p.revision for p in self.get_playlists()}
+    
+    def get_playlist_track_ids(self, kind: str):
+        """(ревизия, [id]) треков плейлиста или None при ошибке"""
+        if not self.client:
+            return None
+        try:
+            playlist = self.client.users_playlists(kind)
+            return playlist.revision, [str(t.id) for t in playlist.tracks]
+        except Exception as e:
+            self.report_error("Ошибка синхронизации плейлиста", e)
+            return None
+    
     def download_track(self, track: Track, path: str) -> bool:
         """Скачать трек"""
         try:
             track.download(path)
             return True
         except Exception as e:
-            logger.error(f"Ошибка скачивания трека: {e}")
+            self.report_error("Ошибка скачивания трека", e)
             return False
 
 # ======= Реализация Spotify =======
@@ -198,7 +285,7 @@ class SpotifyMusicAPI(AbstractMusicAPI):
             logger.info(f"Spotify: авторизован как {me['display_name']}")
             return True
         except Exception as e:
-            logger.error(f"Spotify: ошибка авторизации: {e}")
+            self.report_error("Spotify: ошибка авторизации", e)
             return False
 
     # ---- Данные ----
@@ -214,7 +301,7 @@ class SpotifyMusicAPI(AbstractMusicAPI):
             rec = self.sp.recommendations(seed_tracks=seed_tracks, limit=20)
             return self._convert_tracks([t for t in rec['tracks']])
         except Exception as e:
-            logger.error(f"Spotify: ошибка recommendations: {e}")
+            self.report_error("Spotify: ошибка recommendations", e)
             return []
 
     def get_liked_tracks(self):
@@ -222,7 +309,7 @@ class SpotifyMusicAPI(AbstractMusicAPI):
             results = self.sp.current_user_saved_tracks(limit=50)
             return self._convert_tracks([item['track'] for item in results['items']])
         except Exception as e:
-            logger.error(f"Spotify: ошибка liked_tracks: {e}")
+            self.report_error("Spotify: ошибка liked_tracks", e)
             return []
 
     def get_playlists(self):
@@ -231,7 +318,14 @@ class SpotifyMusicAPI(AbstractMusicAPI):
             # Каждый объект-плейлист имеет метод tracks; вернём json напрямую
             return pls
         except Exception as e:
-            logger.error(f"Spotify: ошибка playlists: {e}")
+            self.report_error("Spotify: ошибка playlists", e)
+            return []
+
+    def get_tracks_by_ids(self, ids):
+        try:
+            return self._convert_tracks([t for t in self.sp.tracks(ids)['tracks'] if t])
+        except Exception as e:
+            self.report_error("Spotify: ошибка получения треков", e)
             return []
 
     def search(self, query: str, type_: str = 'track'):
@@ -245,117 +339,3377 @@ class SpotifyMusicAPI(AbstractMusicAPI):
                 return results['playlists']['items']
             return []
         except Exception as e:
-            logger.error(f"Spotify: ошибка поиска: {e}")
+            self.report_error("Spotify: ошибка поиска", e)
             return []
 
 # ======= Реализация SoundCloud =======
 
 try:
-    import soundcloud
+    import soundcloud
+except ImportError:
+    soundcloud = None
+
+
+class SoundCloudTrack:
+    def __init__(self, track_json):
+        from types import SimpleNamespace
+        self._json = track_json
+        self.id = track_json.get('id')
+        self.title = track_json.get('title')
+        self.duration_ms = track_json.get('duration', 0)
+        self.artists = [SimpleNamespace(name=track_json.get('user', {}).get('username', ''))]
+        self.stream_url = track_json.get('stream_url')
+
+    def get_download_info(self):
+        if self.stream_url:
+            # stream_url уже содержит client_id, если запрошено через /stream
+            return [SimpleNamespace(get_direct_link=lambda: self.stream_url)]
+        return []
+
+
+class SoundCloudMusicAPI(AbstractMusicAPI):
+    """Работа с SoundCloud API. Нужен client_id (можно получить на dev.soundcloud.com)."""
+
+    def __init__(self):
+        self.client = None
+
+    def authenticate(self, client_id: str) -> bool:
+        if soundcloud is None:
+            logger.error("Не установлена библиотека soundcloud (pip install soundcloud)")
+            return False
+        try:
+            self.client = soundcloud.Client(client_id=client_id)
+            logger.info("SoundCloud: клиент инициализирован")
+            return True
+        except Exception as e:
+            self.report_error("SoundCloud: ошибка инициализации", e)
+            return False
+
+    def _convert_tracks(self, items):
+        return [SoundCloudTrack(t) for t in items]
+
+    def search(self, query: str, type_: str = 'track'):
+        try:
+            if type_ == 'track':
+                res = self.client.get('/tracks', q=query, limit=50)
+                return self._convert_tracks(res)
+            return []
+        except Exception as e:
+            self.report_error("SoundCloud: ошибка поиска", e)
+            return []
+
+    def get_playlists(self):
+        return []  # Требует OAuth для приватных плейлистов
+
+    def get_tracks_by_ids(self, ids):
+        try:
+            res = self.client.get('/tracks', ids=",".join(str(i) for i in ids))
+            return self._convert_tracks(res)
+        except Exception as e:
+            self.report_error("SoundCloud: ошибка получения треков", e)
+            return []
+
+# ======= Реализация Last.fm =======
+
+try:
+    import pylast
+except ImportError:
+    pylast = None
+
+
+class LastFmTrack:
+    def __init__(self, track_obj):
+        from types import SimpleNamespace
+        self.track_obj = track_obj
+        self.id = track_obj.get_mbid() or track_obj.title
+        self.title = track_obj.title
+        self.duration_ms = (track_obj.get_duration() or 0)
+        self.artists = [SimpleNamespace(name=track_obj.artist.name)]
+
+    def get_download_info(self):
+        return []  # Last.fm не предоставляет аудио
+
+
+class LastFMMusicAPI(AbstractMusicAPI):
+    """Last.fm API через pylast. audio streaming не поддерживается, используется только метаданные."""
+
+    def __init__(self):
+        self.network = None
+        self.can_scrobble = False
+
+    def authenticate(self, api_key: str) -> bool:
+        """Токен — api_key или api_key:api_secret:session_key (для скробблинга)"""
+        if pylast is None:
+            logger.error("Не установлена библиотека pylast (pip install pylast)")
+            return False
+        try:
+            api_key, _, rest = api_key.partition(":")
+            api_secret, _, session_key = rest.partition(":")
+            self.network = pylast.LastFMNetwork(api_key=api_key, api_secret=api_secret or None,
+                                                session_key=session_key or None)
+            self.can_scrobble = bool(api_secret and session_key)
+            logger.info("Last.fm: клиент инициализирован")
+            return True
+        except Exception as e:
+            self.report_error("Last.fm: ошибка", e)
+            return False
+
+    def search(self, query: str, type_: str = 'track'):
+        try:
+            if type_ == 'track':
+                res = self.network.search_for_track(None, query)
+                tracks = res.get_next_page()
+                return [LastFmTrack(t) for t in tracks]
+            return []
+        except Exception as e:
+            self.report_error("Last.fm: ошибка поиска", e)
+            return []
+
+    # Коды ошибок Last.fm, после которых повтор той же пачки бесполезен
+    SCROBBLE_REJECTED = {"6", "7"}   # некорректные параметры или ресурс
+    SCROBBLE_UNAUTHORIZED = {"4", "9", "10", "13", "14", "15", "17", "26"}
+
+    def scrobble_many(self, scrobbles: List[dict]) -> str:
+        """Отправить пачку скробблов (до 50) одним запросом. Результат: "sent";
+        "retry" — сеть, лимит или временный сбой; "rejected" — Last.fm отверг
+        данные пачки; "unauthorized" — сессия или ключ недействительны"""
+        if not self.can_scrobble:
+            return "unauthorized"
+        try:
+            self.network.scrobble_many([{
+                "artist": s["artist"],
+                "title": s["title"],
+                "timestamp": s["timestamp"],
+                "duration": s.get("duration") or None,
+                "album": s.get("album") or None,
+            } for s in scrobbles])
+            return "sent"
+        except Exception as e:
+            self.report_error("Last.fm: ошибка скробблинга", e)
+            status = str(e.status) if isinstance(e, pylast.WSError) else ""
+            if status in self.SCROBBLE_REJECTED:
+                return "rejected"
+            if status in self.SCROBBLE_UNAUTHORIZED:
+                return "unauthorized"
+            return "retry"
+
+# ======= Федеративный поиск по всем провайдерам =======
+
+
+def normalize_text(text: str) -> str:
+    """Привести название/исполнителя к виду для сравнения между сервисами"""
+    text = unicodedata.normalize("NFKC", text or "").casefold()
+    text = re.sub(r"[\(\[].*?[\)\]]", " ", text)          # (feat. ...), [Remastered]
+    text = re.sub(r"\s-\s.*(remaster|version|edit|mix).*$", " ", text)
+    text = re.sub(r"\b(feat|ft)\..*$", " ", text)
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+
+def track_artist_names(track) -> str:
+    return ", ".join(artist.name for artist in (getattr(track, 'artists', None) or []) if artist.name)
+
+
+class TrackMerger:
+    """Объединяет дубликаты из разных источников по нормализованным
+    названию, первому исполнителю и длительности (с допуском).
+    Трек без длительности совпадает с любой длительностью."""
+
+    DURATION_TOLERANCE_SEC = 3
+
+    def __init__(self):
+        self.tracks = []
+        self._index = {}  # (title, artist) -> [(секунды или None, позиция в self.tracks)]
+
+    @staticmethod
+    def is_playable(track) -> bool:
+        return not isinstance(track, LastFmTrack)
+
+    @staticmethod
+    def _key(track):
+        title = normalize_text(track.title)
+        artists = getattr(track, 'artists', None) or []
+        artist = normalize_text(artists[0].name) if artists else ""
+        return (title, artist), (track.duration_ms or 0) // 1000 or None
+
+    def _find(self, entries, seconds) -> Optional[int]:
+        if seconds is None:
+            return entries[0][1] if entries else None
+        timed = {pos for other, pos in entries if other is not None}
+        for other, pos in entries:
+            if other is None:
+                if pos not in timed:   # длительность этого трека ещё неизвестна
+                    return pos
+            elif abs(seconds - other) <= self.DURATION_TOLERANCE_SEC:
+                return pos
+        return None
+
+    def add(self, tracks):
+        """Добавить пачку треков. Возвращает (новые треки, [(позиция, трек)] замен)"""
+        added, replaced = [], []
+        for track in tracks:
+            if hasattr(track, 'track'):
+                track = track.track
+            key, seconds = self._key(track)
+            entries = self._index.setdefault(key, [])
+            pos = self._find(entries, seconds)
+            if pos is None or seconds is not None:
+                entries.append((seconds, len(self.tracks) if pos is None else pos))
+            if pos is None:
+                self.tracks.append(track)
+                added.append(track)
+                continue
+            # Метаданные без аудио (Last.fm) уступают воспроизводимой версии
+            if not self.is_playable(self.tracks[pos]) and self.is_playable(track):
+                self.tracks[pos] = track
+                replaced.append((pos, track))
+        return added, replaced
+
+
+class FederatedSearch(QObject):
+    """Параллельный поиск по всем авторизованным провайдерам. Каждый
+    провайдер опрашивается в своём потоке и имеет собственный дедлайн;
+    результаты приходят по мере готовности, опоздавшие отбрасываются."""
+
+    results_ready = pyqtSignal(str, list, list)   # провайдер, новые треки, замены
+    provider_failed = pyqtSignal(str, str)        # провайдер, причина
+    provider_authenticated = pyqtSignal(str, object)  # провайдер, API, авторизованный при поиске
+    finished = pyqtSignal()
+
+    DEFAULT_DEADLINE_SEC = 8.0
+    DEADLINES_SEC = {
+        "Last.fm": 5.0,  # pylast часто отвечает медленно
+    }
+
+    _provider_done = pyqtSignal(int, str, object, str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._generation = 0
+        self._pending = set()
+        self.merger = TrackMerger()
+        self._provider_done.connect(self._on_provider_done)
+
+    @property
+    def running(self) -> bool:
+        return bool(self._pending)
+
+    def start(self, query: str, providers: Dict[str, Any]):
+        """providers: имя -> (экземпляр API, токен). Токен пустой, если API уже
+        авторизован; иначе поток поиска авторизует свой, ни с кем не общий
+        экземпляр, а сообщение о нём приходит сигналом provider_authenticated"""
+        self._generation += 1
+        generation = self._generation
+        self._pending = set(providers)
+        self.merger = TrackMerger()
+
+        for name, (api, token) in providers.items():
+            thread = threading.Thread(target=self._run, args=(generation, name, api, token, query),
+                                      name=f"search-{name}", daemon=True)
+            thread.start()
+            deadline = self.DEADLINES_SEC.get(name, self.DEFAULT_DEADLINE_SEC)
+            QTimer.singleShot(int(deadline * 1000), lambda n=name: self._on_deadline(generation, n))
+
+        if not self._pending:
+            self.finished.emit()
+
+    def cancel(self):
+        self._generation += 1
+        self._pending.clear()
+
+    def _run(self, generation: int, name: str, api, token: str, query: str):
+        # Выполняется в фоновом потоке, результат возвращается сигналом в GUI
+        try:
+            if token and not api.authenticate(token):
+                self._provider_done.emit(generation, name, None, "нет авторизации")
+                return
+            tracks = api.search(query, 'track')
+            self._provider_done.emit(generation, name, (tracks, api if token else None), "")
+        except Exception as e:
+            self._provider_done.emit(generation, name, None, str(e))
+
+    def _on_provider_done(self, generation: int, name: str, result, error: str):
+        tracks, new_api = result or (None, None)
+        if new_api is not None:
+            self.provider_authenticated.emit(name, new_api)
+        if generation != self._generation or name not in self._pending:
+            return  # Устаревший поиск или провайдер уже вышел по таймауту
+        self._pending.discard(name)
+        if tracks is None:
+            self.provider_failed.emit(name, error)
+        else:
+            added, replaced = self.merger.add(tracks)
+            self.results_ready.emit(name, added, replaced)
+        if not self._pending:
+            self.finished.emit()
+
+    def _on_deadline(self, generation: int, name: str):
+        if generation != self._generation or name not in self._pending:
+            return
+        logger.warning(f"Поиск: {name} не ответил вовремя")
+        self._pending.discard(name)
+        self.provider_failed.emit(name, "таймаут")
+        if not self._pending:
+            self.finished.emit()
+
+# ======= Локальные файлы =======
+
+try:
+    import mutagen
+except ImportError:
+    mutagen = None  # Без mutagen метаданные берутся из имени файла
+
+
+class LocalTrack:
+    """Трек из локальной папки с музыкой"""
+
+    def __init__(self, path: str):
+        self.id = path
+        self.path = path
+        stem = Path(path).stem
+        artist, _, title = stem.partition(" - ")
+        if not title:
+            artist, title = "", stem
+        self.title = title.strip()
+        self.duration_ms = 0
+        if mutagen is not None:
+            try:
+                info = mutagen.File(path, easy=True)
+                if info is not None:
+                    self.title = (info.get("title") or [self.title])[0]
+                    artist = (info.get("artist") or [artist])[0]
+                    self.duration_ms = int(info.info.length * 1000)
+            except Exception as e:
+                logger.debug(f"Локальные файлы: не удалось прочитать теги {path}: {e}")
+        self.artists = [SimpleNamespace(name=artist.strip())] if artist.strip() else []
+
+    def get_download_info(self):
+        url = QUrl.fromLocalFile(self.path).toString()
+        return [SimpleNamespace(get_direct_link=lambda: url)]
+
+
+class LocalFilesMusicAPI(AbstractMusicAPI):
+    """Поиск по локальной папке с музыкой. Вместо токена указывается путь к папке."""
+
+    EXTENSIONS = {".mp3", ".flac", ".ogg", ".opus", ".m4a", ".wav"}
+
+    def __init__(self):
+        self.root = None
+        self.tracks = []
+
+    def authenticate(self, path: str) -> bool:
+        root = Path(path).expanduser()
+        if not root.is_dir():
+            logger.error(f"Локальные файлы: папка не найдена: {root}")
+            return False
+        self.root = root
+        self.tracks = [LocalTrack(str(p)) for p in sorted(root.rglob("*"))
+                       if p.suffix.lower() in self.EXTENSIONS]
+        logger.info(f"Локальные файлы: найдено {len(self.tracks)} треков в {root}")
+        return True
+
+    def get_liked_tracks(self):
+        return list(self.tracks)
+
+    def search(self, query: str, type_: str = 'track'):
+        if type_ != 'track':
+            return []
+        words = normalize_text(query).split()
+        return [t for t in self.tracks
+                if all(w in normalize_text(f"{track_artist_names(t)} {t.title}") for w in words)]
+
+    def get_tracks_by_ids(self, ids):
+        return [LocalTrack(i) for i in ids if os.path.isfile(i)]
+
+# ======= Сопоставление треков Last.fm с воспроизводимыми =======
+
+class TrackResolver:
+    """Находит для треков без аудио (Last.fm) воспроизводимую версию у другого
+    провайдера. Кандидаты ищутся параллельно, оценка считается векторно по
+    триграммам названия/исполнителя и длительности, найденные соответствия
+    сохраняются на диск, так что каждый трек разрешается один раз."""
+
+    PLAYABLE_PROVIDERS = ("Yandex", "SoundCloud", "Local")
+    MIN_SCORE = 0.7
+    MISS_TTL_SEC = 7 * 24 * 3600   # повторный поиск для ненайденных — раз в неделю
+    TRIGRAM_DIM = 1024
+    MAX_WORKERS = 4
+
+    def __init__(self, get_api, cache_path: Path = CACHE_DIR / "matches.json"):
+        self.get_api = get_api
+        self.cache_path = cache_path
+        self._lock = threading.Lock()
+        self._cache = {}
+        try:
+            self._cache = json.loads(cache_path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Кэш сопоставлений повреждён, начинаем заново: {e}")
+
+    @staticmethod
+    def cache_key(track) -> str:
+        return f"{normalize_text(track_artist_names(track))}|{normalize_text(track.title)}"
+
+    def _save(self):
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.cache_path.with_suffix(".tmp")
+        # Запись и замена под одной блокировкой: разрешение идёт из нескольких потоков
+        with self._lock:
+            tmp.write_text(json.dumps(self._cache, ensure_ascii=False), encoding="utf-8")
+            os.replace(tmp, self.cache_path)
+
+    def _provider(self):
+        for name in self.PLAYABLE_PROVIDERS:
+            api = self.get_api(name)
+            if api is not None:
+                return name, api
+        return None, None
+
+    def resolve(self, tracks, on_resolved=None) -> Dict[int, Any]:
+        """Разрешить пачку треков. Возвращает {индекс: воспроизводимый трек};
+        on_resolved(индекс, трек) вызывается по мере готовности (из фонового потока)"""
+        if np is None:
+            logger.warning("Сопоставление треков недоступно: установите numpy (pip install numpy)")
+            return {}
+        name, api = self._provider()
+        if api is None:
+            logger.warning("Сопоставление треков: нет авторизованного воспроизводимого источника")
+            return {}
+
+        resolved = {}
+
+        def emit(index, track):
+            resolved[index] = track
+            if on_resolved:
+                on_resolved(index, track)
+
+        # 1. Попадания в кэш подтягиваем одним пакетным запросом
+        cached, todo = {}, []
+        now = time.time()
+        for i, track in enumerate(tracks):
+            entry = self._cache.get(self.cache_key(track))
+            if entry and entry.get("provider") == name and entry.get("id") is not None:
+                cached.setdefault(str(entry["id"]), []).append(i)
+            elif entry and entry.get("id") is None and now - entry.get("ts", 0) < self.MISS_TTL_SEC:
+                continue
+            else:
+                todo.append(i)
+        if cached:
+            for track in api.get_tracks_by_ids(list(cached)):
+                for i in cached.get(str(track.id), []):
+                    emit(i, track)
+
+        # 2. Остальное ищем параллельно
+        def candidates(i):
+            track = tracks[i]
+            query = f"{track_artist_names(track)} {track.title}".strip()
+            return i, [c.track if hasattr(c, 'track') else c for c in api.search(query, 'track')[:10]]
+
+        # Потоки пула не наследуют контекст: передаём приоритет запросов явно
+        context = contextvars.copy_context()
+        with ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as pool:
+            found = list(pool.map(lambda i: context.copy().run(candidates, i), todo))
+
+        # 3. Векторная оценка всех кандидатов всех треков сразу
+        owners, cands = [], []
+        for i, items in found:
+            owners.extend([i] * len(items))
+            cands.extend(items)
+        scores = self.score(tracks, owners, cands) if cands else np.zeros(0)
+
+        best = {}
+        for row, i in enumerate(owners):
+            if scores[row] >= self.MIN_SCORE and scores[row] > best.get(i, (-1, None))[0]:
+                best[i] = (scores[row], cands[row])
+        with self._lock:
+            for i, _ in found:
+                key = self.cache_key(tracks[i])
+                match = best.get(i)
+                self._cache[key] = {"provider": name, "id": match[1].id if match else None, "ts": now}
+        for i, (_, track) in best.items():
+            emit(i, track)
+
+        if found:
+            self._save()
+        return resolved
+
+    def _trigrams(self, texts):
+        matrix = np.zeros((len(texts), self.TRIGRAM_DIM), dtype=np.float32)
+        for row, text in enumerate(texts):
+            padded = f"  {text} "
+            for j in range(len(padded) - 2):
+                matrix[row, zlib.crc32(padded[j:j + 3].encode()) % self.TRIGRAM_DIM] += 1
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.maximum(norms, 1e-9)
+
+    def score(self, tracks, owners, cands):
+        """Оценка [0..1] для каждой пары (tracks[owners[k]], cands[k])"""
+        owners = np.asarray(owners)
+        queries = [tracks[i] for i in owners]
+        title_sim = np.einsum("ij,ij->i",
+                              self._trigrams([normalize_text(t.title) for t in queries]),
+                              self._trigrams([normalize_text(c.title) for c in cands]))
+        artist_sim = np.einsum("ij,ij->i",
+                               self._trigrams([normalize_text(track_artist_names(t)) for t in queries]),
+                               self._trigrams([normalize_text(track_artist_names(c)) for c in cands]))
+        dq = np.array([(t.duration_ms or 0) / 1000 for t in queries], dtype=np.float32)
+        dc = np.array([(c.duration_ms or 0) / 1000 for c in cands], dtype=np.float32)
+        duration_sim = np.where((dq > 0) & (dc > 0), np.exp(-np.abs(dq - dc) / 5.0), 0.5)
+        return 0.55 * title_sim + 0.3 * artist_sim + 0.15 * duration_sim
+
+# ======= Снимок сессии =======
+
+def track_provider(track) -> str:
+    """Имя провайдера, которому принадлежит объект трека"""
+    if isinstance(track, SnapshotTrack):
+        return track.provider
+    for cls, name in ((SpotifyTrack, "Spotify"), (SoundCloudTrack, "SoundCloud"),
+                      (LastFmTrack, "Last.fm"), (LocalTrack, "Local")):
+        if isinstance(track, cls):
+            return name
+    return "Yandex"
+
+
+class SnapshotTrack:
+    """Трек, восстановленный из снимка сессии: только метаданные.
+    Настоящий объект провайдера подгружается при воспроизведении."""
+
+    def __init__(self, record: dict):
+        self.provider = record.get("p", "Yandex")
+        self.id = record.get("i")
+        self.title = record.get("t", "")
+        self.duration_ms = record.get("d", 0)
+        self.artists = [SimpleNamespace(name=name) for name in record.get("a", [])]
+
+    @staticmethod
+    def record(track) -> dict:
+        if hasattr(track, 'track'):
+            track = track.track
+        return {
+            "p": track_provider(track),
+            "i": track.id,
+            "t": track.title,
+            "a": [artist.name for artist in (track.artists or [])],
+            "d": track.duration_ms or 0,
+        }
+
+    def get_download_info(self):
+        return []  # Сначала нужно получить трек у провайдера
+
+
+class SessionJournal:
+    """Бинарный журнал состояния сессии (очередь, видимый список, позиция).
+    Изменения дописываются в конец файла короткими записями, при разрастании
+    файл сжимается до одной полной записи. Загрузка не требует сети.
+
+    Формат: MAGIC, версия (u16), затем записи <длина u32><тип u8><crc32 u32><данные>.
+    Оборванная или повреждённая запись в конце файла (сбой при записи)
+    просто отбрасывается вместе со всем, что идёт после неё."""
+
+    MAGIC = b"YMPS"
+    VERSION = 1
+    HEADER = struct.Struct("<4sH")
+    RECORD = struct.Struct("<IBI")
+    POSITION = struct.Struct("<iI")
+
+    REC_FULL = 1
+    REC_QUEUE = 2
+    REC_VISIBLE = 3        # пустые данные: видимый список совпадает с очередью
+    REC_POSITION = 4
+
+    COMPACT_BYTES = 256 * 1024
+
+    def __init__(self, path: Path = CACHE_DIR / "session.bin"):
+        self.path = path
+        self.state = {"queue": [], "visible": None, "index": 0, "position_ms": 0}
+        self._file = None
+        self._broken = False  # хвост файла повреждён — перед дозаписью переписать
+
+    # ---- Чтение ----
+
+    def load(self) -> dict:
+        """Прочитать журнал и вернуть состояние. visible=None — совпадает с queue"""
+        try:
+            data = self.path.read_bytes()
+        except FileNotFoundError:
+            return self.state
+        except OSError as e:
+            logger.warning(f"Снимок сессии: не удалось прочитать {self.path}: {e}")
+            return self.state
+
+        if len(data) < self.HEADER.size or self.HEADER.unpack_from(data) != (self.MAGIC, self.VERSION):
+            logger.warning("Снимок сессии: неизвестный формат, начинаем заново")
+            self._broken = True
+            return self.state
+
+        offset = self.HEADER.size
+        while offset + self.RECORD.size <= len(data):
+            length, kind, crc = self.RECORD.unpack_from(data, offset)
+            payload = data[offset + self.RECORD.size:offset + self.RECORD.size + length]
+            if len(payload) != length or zlib.crc32(payload) != crc:
+                break
+            self._apply(kind, payload)
+            offset += self.RECORD.size + length
+        if offset != len(data):
+            # Включая хвост короче заголовка записи: новые записи за ним не прочитались бы
+            logger.warning("Снимок сессии: обрезанная запись в конце журнала отброшена")
+            self._broken = True
+        return self.state
+
+    def _apply(self, kind: int, payload: bytes):
+        if kind == self.REC_POSITION:
+            self.state["index"], self.state["position_ms"] = self.POSITION.unpack(payload)
+        elif kind == self.REC_QUEUE:
+            self.state["queue"] = self._decode(payload)
+        elif kind == self.REC_VISIBLE:
+            self.state["visible"] = self._decode(payload) if payload else None
+        elif kind == self.REC_FULL:
+            self.state = self._decode(payload)
+
+    @staticmethod
+    def _encode(obj) -> bytes:
+        return zlib.compress(json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+    @staticmethod
+    def _decode(payload: bytes):
+        return json.loads(zlib.decompress(payload).decode("utf-8"))
+
+    # ---- Запись ----
+
+    def _append(self, kind: int, payload: bytes):
+        try:
+            if self._file is None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                if self._broken or not self.path.exists() or self.path.stat().st_size < self.HEADER.size:
+                    self._rewrite()
+                    self._broken = False
+                self._file = open(self.path, "ab")
+            self._file.write(self.RECORD.pack(len(payload), kind, zlib.crc32(payload)) + payload)
+            self._file.flush()
+            if self._file.tell() > self.COMPACT_BYTES:
+                self.compact()
+        except OSError as e:
+            logger.error(f"Снимок сессии: ошибка записи: {e}")
+
+    def set_lists(self, queue, visible):
+        """Сохранить очередь и видимый список (списки объектов-треков)"""
+        self.state["queue"] = [SnapshotTrack.record(t) for t in queue]
+        self._append(self.REC_QUEUE, self._encode(self.state["queue"]))
+        if visible is queue:
+            self.state["visible"] = None
+            self._append(self.REC_VISIBLE, b"")
+        else:
+            self.state["visible"] = [SnapshotTrack.record(t) for t in visible]
+            self._append(self.REC_VISIBLE, self._encode(self.state["visible"]))
+
+    def set_position(self, index: int, position_ms: int):
+        if (index, position_ms) == (self.state["index"], self.state["position_ms"]):
+            return
+        self.state["index"], self.state["position_ms"] = index, position_ms
+        self._append(self.REC_POSITION, self.POSITION.pack(index, max(position_ms, 0)))
+
+    def _rewrite(self):
+        """Записать файл заново: заголовок и одна полная запись"""
+        payload = self._encode(self.state)
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.VERSION))
+            f.write(self.RECORD.pack(len(payload), self.REC_FULL, zlib.crc32(payload)) + payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def compact(self):
+        """Свернуть журнал в одну полную запись"""
+        try:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._rewrite()
+        except OSError as e:
+            logger.error(f"Снимок сессии: ошибка сжатия журнала: {e}")
+
+# ======= Движок кроссфейда и бесшовного воспроизведения =======
+
+CROSSFADE_CURVES = ("linear", "equal_power", "s_curve")
+
+
+def crossfade_gains(length: int, curve: str = "equal_power"):
+    """Вернуть пару массивов (затухание, нарастание) длиной length"""
+    t = (np.arange(length, dtype=np.float32) + 0.5) / max(length, 1)
+    if curve == "linear":
+        fade_in = t
+    elif curve == "s_curve":
+        fade_in = 0.5 - 0.5 * np.cos(np.pi * t)
+    else:
+        # equal_power: сохраняет суммарную громкость некоррелированных сигналов
+        return np.cos(t * np.pi / 2), np.sin(t * np.pi / 2)
+    return 1.0 - fade_in, fade_in
+
+
+class AudioRingBuffer:
+    """Кольцевой буфер PCM-кадров float32 формы (frames, channels).
+    Пишет декодер, читает микшер; оба живут в потоке движка, но блокировка
+    оставлена, чтобы буфер можно было безопасно опрашивать из GUI."""
+
+    def __init__(self, capacity: int, channels: int):
+        self._data = np.zeros((capacity, channels), dtype=np.float32)
+        self.capacity = capacity
+        self._read = 0
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @property
+    def available(self) -> int:
+        return self._size
+
+    @property
+    def free(self) -> int:
+        return self.capacity - self._size
+
+    def write(self, frames) -> int:
+        """Записать кадры, вернуть количество реально записанных"""
+        with self._lock:
+            count = min(len(frames), self.capacity - self._size)
+            start = (self._read + self._size) % self.capacity
+            first = min(count, self.capacity - start)
+            self._data[start:start + first] = frames[:first]
+            self._data[:count - first] = frames[first:count]
+            self._size += count
+            return count
+
+    def read(self, count: int):
+        """Прочитать до count кадров"""
+        with self._lock:
+            count = min(count, self._size)
+            first = min(count, self.capacity - self._read)
+            out = np.concatenate((self._data[self._read:self._read + first],
+                                  self._data[:count - first]))
+            self._read = (self._read + count) % self.capacity
+            self._size -= count
+            return out
+
+    def clear(self):
+        with self._lock:
+            self._read = 0
+            self._size = 0
+
+
+class _DecoderDeck(QObject):
+    """Декодирует один трек через QAudioDecoder в кольцевой буфер"""
+
+    def __init__(self, source: str, fmt: QAudioFormat, capacity: int,
+                 network: QNetworkAccessManager, parent=None):
+        super().__init__(parent)
+        self.source = source
+        self.channels = fmt.channelCount()
+        self.ring = AudioRingBuffer(capacity, self.channels)
+        self.frames_played = 0
+        self.fade_total = 0
+        self.fade_gains = None   # кривые наложения, считаются один раз в начале
+        self.finished = False
+        self._decoded = False
+        self._reply = None
+
+        self.decoder = QAudioDecoder(self)
+        self.decoder.setAudioFormat(fmt)
+        self.decoder.bufferReady.connect(self.drain)
+        self.decoder.finished.connect(self._on_finished)
+        self.decoder.error.connect(self._on_error)
+
+        if source.startswith(("http://", "https://")):
+            self._reply = network.get(QNetworkRequest(QUrl(source)))
+            self.decoder.setSourceDevice(self._reply)
+        else:
+            # Локальные треки приходят ссылкой file://, файлы из кэша — путём
+            path = QUrl(source).toLocalFile() if source.startswith("file:") else source
+            self.decoder.setSourceFilename(path)
+        self.decoder.start()
+
+    @property
+    def exhausted(self) -> bool:
+        return self.finished and self.ring.available == 0
+
+    def drain(self):
+        """Забрать готовые буферы декодера, пока в кольце есть место"""
+        while self.decoder.bufferAvailable() and self.ring.free >= self.ring.capacity // 8:
+            buf = self.decoder.read()
+            if not buf.isValid():
+                break
+            raw = buf.constData().asstring(buf.byteCount())
+            pcm = np.frombuffer(raw, dtype=np.int16).reshape(-1, self.channels)
+            self.ring.write(pcm.astype(np.float32) / 32768.0)
+        # Оставшиеся после finished буферы забираются на следующих тиках микшера
+        if self._decoded and not self.decoder.bufferAvailable():
+            self.finished = True
+
+    def _on_finished(self):
+        self._decoded = True
+        self.drain()
+
+    def _on_error(self, error):
+        logger.error(f"Кроссфейд: ошибка декодирования {self.source}: {self.decoder.errorString()}")
+        self.finished = True
+
+    def release(self):
+        self.decoder.stop()
+        if self._reply is not None:
+            self._reply.abort()
+            self._reply.deleteLater()
+        self.deleteLater()
+
+
+class _MixerWorker(QObject):
+    """Живёт в отдельном QThread: декодирует, микширует и пишет в QAudioOutput"""
+
+    state_changed = pyqtSignal(int)
+    position_changed = pyqtSignal(int)
+    track_changed = pyqtSignal(str)
+
+    SAMPLE_RATE = 44100
+    CHANNELS = 2
+    TICK_MS = 10
+    OUTPUT_BUFFER_MS = 150
+    DECODE_AHEAD_SEC = 20
+
+    def __init__(self):
+        super().__init__()
+        self.output = None
+        self.device = None
+        self.current = None
+        self.next = None
+        self.paused = False
+        self.volume = 0.5
+        self.crossfade_frames = 0
+        self.curve = "equal_power"
+        self._last_position = -1
+
+    @pyqtSlot()
+    def setup(self):
+        """Создать аудиовыход и таймер уже внутри потока движка"""
+        self.format = QAudioFormat()
+        self.format.setSampleRate(self.SAMPLE_RATE)
+        self.format.setChannelCount(self.CHANNELS)
+        self.format.setSampleSize(16)
+        self.format.setCodec("audio/pcm")
+        self.format.setByteOrder(QAudioFormat.LittleEndian)
+        self.format.setSampleType(QAudioFormat.SignedInt)
+        self.bytes_per_frame = self.CHANNELS * 2
+
+        self.network = QNetworkAccessManager(self)
+        self.output = QAudioOutput(self.format, self)
+        self.output.setBufferSize(self.SAMPLE_RATE * self.bytes_per_frame * self.OUTPUT_BUFFER_MS // 1000)
+        self.output.setVolume(self.volume)
+
+        self.timer = QTimer(self)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.setInterval(self.TICK_MS)
+        self.timer.timeout.connect(self.tick)
+
+    def _make_deck(self, source: str) -> _DecoderDeck:
+        return _DecoderDeck(source, self.format, self.SAMPLE_RATE * self.DECODE_AHEAD_SEC,
+                            self.network, self)
+
+    @pyqtSlot(str)
+    def play(self, source: str):
+        self._release_decks()
+        self.current = self._make_deck(source)
+        self.paused = False
+        self._last_position = -1
+        if self.device is None or self.output.state() == QAudio.StoppedState:
+            self.device = self.output.start()
+        else:
+            self.output.resume()
+        self.timer.start()
+        self.state_changed.emit(QMediaPlayer.PlayingState)
+
+    @pyqtSlot(str)
+    def queue_next(self, source: str):
+        if self.next is not None:
+            self.next.release()
+        self.next = self._make_deck(source) if source else None
+
+    @pyqtSlot()
+    def pause(self):
+        if self.current is None:
+            return
+        self.paused = True
+        self.output.suspend()
+        self.state_changed.emit(QMediaPlayer.PausedState)
+
+    @pyqtSlot()
+    def resume(self):
+        if self.current is None:
+            return
+        self.paused = False
+        self.output.resume()
+        self.state_changed.emit(QMediaPlayer.PlayingState)
+
+    @pyqtSlot()
+    def stop(self):
+        self.timer.stop()
+        self._release_decks()
+        if self.output is not None:
+            self.output.stop()
+        self.device = None
+        self.state_changed.emit(QMediaPlayer.StoppedState)
+
+    @pyqtSlot(float)
+    def set_volume(self, volume: float):
+        self.volume = volume
+        if self.output is not None:
+            self.output.setVolume(volume)
+
+    @pyqtSlot(int, str)
+    def set_crossfade(self, duration_ms: int, curve: str):
+        self.crossfade_frames = self.SAMPLE_RATE * max(duration_ms, 0) // 1000
+        self.curve = curve if curve in CROSSFADE_CURVES else "equal_power"
+
+    def _release_decks(self):
+        for deck in (self.current, self.next):
+            if deck is not None:
+                deck.release()
+        self.current = None
+        self.next = None
+
+    def tick(self):
+        for deck in (self.current, self.next):
+            if deck is not None:
+                deck.drain()
+        if self.paused or self.current is None or self.device is None:
+            return
+
+        frames = self.output.bytesFree() // self.bytes_per_frame
+        if frames <= 0:
+            return
+        mixed = self._mix(frames)
+        if len(mixed):
+            pcm = (np.clip(mixed, -1.0, 1.0) * 32767.0).astype('<i2')
+            self.device.write(pcm.tobytes())
+
+        if self.current is None:
+            return
+        position = self.current.frames_played * 1000 // self.SAMPLE_RATE
+        if position // 1000 != self._last_position // 1000:
+            self._last_position = position
+            self.position_changed.emit(position)
+
+    def _mix(self, frames: int):
+        """Собрать до frames кадров; при недостатке данных вернуть меньше,
+        а не дополнять тишиной, чтобы не вносить паузы в поток"""
+        chunks = []
+        need = frames
+        while need > 0 and self.current is not None:
+            cur, nxt = self.current, self.next
+            overlap = (nxt is not None and self.crossfade_frames > 0 and cur.finished
+                       and cur.ring.available <= self.crossfade_frames)
+            if overlap and not cur.fade_total:
+                # Начинать наложение, только когда у следующего трека есть запас
+                if nxt.ring.available >= cur.ring.available or nxt.finished:
+                    cur.fade_total = cur.ring.available
+                    cur.fade_gains = crossfade_gains(cur.fade_total, self.curve)
+            if cur.fade_total:
+                done = cur.fade_total - cur.ring.available
+                count = min(need, cur.ring.available)
+                fade_out, fade_in = cur.fade_gains
+                out_part = cur.ring.read(count) * fade_out[done:done + count, None]
+                in_part = nxt.ring.read(count)
+                mixed = out_part
+                mixed[:len(in_part)] += in_part * fade_in[done:done + len(in_part), None]
+                cur.frames_played += count
+                nxt.frames_played += len(in_part)
+                chunks.append(mixed)
+                need -= count
+            else:
+                count = need
+                if not overlap and nxt is not None and self.crossfade_frames > 0 and cur.finished:
+                    # Не заходить в зону наложения обычным чтением
+                    count = min(need, cur.ring.available - self.crossfade_frames)
+                chunk = cur.ring.read(count)
+                if len(chunk) == 0 and not cur.finished:
+                    break  # Декодер не успевает: ждём следующего тика
+                cur.frames_played += len(chunk)
+                chunks.append(chunk)
+                need -= len(chunk)
+
+            if cur.exhausted:
+                self._advance()
+        if not chunks:
+            return np.zeros((0, self.CHANNELS), dtype=np.float32)
+        return np.concatenate(chunks)
+
+    def _advance(self):
+        """Текущий трек доигран: переключиться на следующий без паузы"""
+        finished = self.current
+        self.current, self.next = self.next, None
+        finished.release()
+        if self.current is None:
+            self.timer.stop()
+            self.state_changed.emit(QMediaPlayer.StoppedState)
+        else:
+            self._last_position = -1
+            self.track_changed.emit(self.current.source)
+
+
+class CrossfadeEngine(QObject):
+    """Необязательная замена QMediaPlayer с кроссфейдом и бесшовными переходами.
+    Управление из GUI-потока, вся работа со звуком — в отдельном потоке,
+    поэтому занятый интерфейс не приводит к опустошению аудиобуфера."""
+
+    stateChanged = pyqtSignal(int)
+    positionChanged = pyqtSignal(int)
+    track_changed = pyqtSignal(str)
+
+    _play = pyqtSignal(str)
+    _queue_next = pyqtSignal(str)
+    _pause = pyqtSignal()
+    _resume = pyqtSignal()
+    _stop = pyqtSignal()
+    _set_volume = pyqtSignal(float)
+    _set_crossfade = pyqtSignal(int, str)
+
+    def __init__(self, crossfade_ms: int = 6000, curve: str = "equal_power", parent=None):
+        super().__init__(parent)
+        self._state = QMediaPlayer.StoppedState
+        self._position = 0
+        self._volume = 50
+
+        self.thread = QThread()
+        self.worker = _MixerWorker()
+        self.worker.moveToThread(self.thread)
+        self.thread.started.connect(self.worker.setup)
+
+        self._play.connect(self.worker.play)
+        self._queue_next.connect(self.worker.queue_next)
+        self._pause.connect(self.worker.pause)
+        self._resume.connect(self.worker.resume)
+        self._stop.connect(self.worker.stop)
+        self._set_volume.connect(self.worker.set_volume)
+        self._set_crossfade.connect(self.worker.set_crossfade)
+
+        self.worker.state_changed.connect(self._on_state_changed)
+        self.worker.position_changed.connect(self._on_position_changed)
+        self.worker.track_changed.connect(self.track_changed)
+
+        self.thread.start(QThread.TimeCriticalPriority)
+        self.set_crossfade(crossfade_ms, curve)
+
+    def play_source(self, source: str):
+        self._position = 0
+        self._play.emit(source)
+
+    def queue_next(self, source: str):
+        """Указать трек, который начнётся с наложением после текущего"""
+        self._queue_next.emit(source or "")
+
+    def play(self):
+        self._resume.emit()
+
+    def pause(self):
+        self._pause.emit()
+
+    def stop(self):
+        self._stop.emit()
+
+    def state(self) -> int:
+        return self._state
+
+    def position(self) -> int:
+        return self._position
+
+    def duration(self) -> int:
+        return 0  # Длительность берётся из метаданных трека
+
+    def volume(self) -> int:
+        return self._volume
+
+    def setVolume(self, volume: int):
+        self._volume = volume
+        self._set_volume.emit(volume / 100.0)
+
+    def set_crossfade(self, duration_ms: int, curve: str = "equal_power"):
+        self._set_crossfade.emit(int(duration_ms), curve)
+
+    def shutdown(self):
+        self._stop.emit()
+        self.thread.quit()
+        self.thread.wait(2000)
+
+    def _on_state_changed(self, state: int):
+        self._state = state
+        self.stateChanged.emit(state)
+
+    def _on_position_changed(self, position: int):
+        self._position = position
+        self.positionChanged.emit(position)
+
+# ======= Планировщик запросов к провайдерам =======
+
+class Priority(IntEnum):
+    """Классы приоритета запросов: меньше — важнее"""
+    INTERACTIVE = 0   # поиск и воспроизведение по действию пользователя
+    PREFETCH = 1      # подготовка данных, которые скоро понадобятся
+    BACKGROUND = 2    # синхронизация, скробблинг и прочая фоновая работа
+
+
+_request_priority = contextvars.ContextVar("request_priority", default=Priority.INTERACTIVE)
+
+
+def retry_after_from_error(error: Exception) -> Optional[float]:
+    """Если ошибка означает превышение лимита (HTTP 429), вернуть паузу в секундах"""
+    response = getattr(error, 'response', None)
+    status = (getattr(error, 'http_status', None) or getattr(error, 'status_code', None)
+              or getattr(response, 'status_code', None))
+    headers = getattr(error, 'headers', None) or getattr(response, 'headers', None) or {}
+    if str(getattr(error, 'status', '')) == "29":   # pylast: Rate limit exceeded
+        status = 429
+    if status is None and isinstance(error, YandexNetworkError):
+        # yandex-music не сохраняет ответ, код есть только в тексте: "... (429): ..."
+        match = re.search(r"\((\d{3})\)(?::|$)", str(error))
+        status = int(match.group(1)) if match else None
+    if status != 429:
+        return None
+    try:
+        return max(float(headers.get("Retry-After", 5)), 0.0)
+    except (TypeError, ValueError):
+        return 5.0
+
+
+class TokenBucket:
+    """Бюджет запросов провайдера: rate токенов в секунду, не больше burst.
+    После 429 скорость снижается вдвое и плавно восстанавливается по успешным ответам."""
+
+    MIN_RATE_FACTOR = 0.1
+    RECOVERY_STEP = 0.05
+
+    def __init__(self, rate: float, burst: int):
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.penalties = 0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, reserve: float = 0.0) -> float:
+        """Взять токен, не опускаясь ниже reserve. Вернуть 0 при успехе,
+        иначе примерное время ожидания в секундах"""
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        if self.tokens - 1.0 >= reserve:
+            self.tokens -= 1.0
+            return 0.0
+        return (reserve + 1.0 - self.tokens) / self.rate
+
+    def penalize(self, retry_after: float):
+        self.penalties += 1
+        self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+        self.rate = max(self.base_rate * self.MIN_RATE_FACTOR, self.rate / 2)
+        self.tokens = 0.0
+
+    def reward(self):
+        self.rate = min(self.base_rate, self.rate + self.base_rate * self.RECOVERY_STEP)
+
+
+class RequestScheduler:
+    """Пропускает вызовы провайдеров через бюджеты с учётом приоритета.
+    Вызов выполняется в потоке вызывающего; менее важные запросы ждут,
+    пока есть более важные ожидающие, и не могут израсходовать резерв
+    бюджета, отложенный для интерактивных действий."""
+
+    # Провайдер -> (запросов в секунду, размер пачки); None — без ограничений
+    BUDGETS = {
+        "Yandex": (5.0, 10),
+        "Spotify": (3.0, 10),
+        "Last.fm": (4.0, 5),     # правила Last.fm: не более 5 запросов в секунду
+        "SoundCloud": (2.0, 5),
+        "Local": None,
+    }
+    DEFAULT_BUDGET = (2.0, 5)
+    # Доля пачки, недоступная для класса приоритета
+    RESERVE = {
+        Priority.INTERACTIVE: 0.0,
+        Priority.PREFETCH: 0.3,
+        Priority.BACKGROUND: 0.5,
+    }
+    # Интерактивные вызовы идут из потока интерфейса: после 429 они ждут
+    # не больше этого и выполняются, долгие паузы — только для фоновых
+    INTERACTIVE_MAX_WAIT_SEC = 0.5
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._buckets = {}
+        self._waiting = {}   # провайдер -> [число ожидающих по приоритетам]
+
+    @staticmethod
+    @contextmanager
+    def priority(level: Priority):
+        """Выполнить блок с заданным приоритетом запросов (в текущем потоке)"""
+        token = _request_priority.set(level)
+        try:
+            yield
+        finally:
+            _request_priority.reset(token)
+
+    def bucket(self, provider: str) -> Optional[TokenBucket]:
+        if provider not in self._buckets:
+            budget = self.BUDGETS.get(provider, self.DEFAULT_BUDGET)
+            self._buckets[provider] = TokenBucket(*budget) if budget else None
+        return self._buckets[provider]
+
+    def _acquire(self, provider: str, level: Priority):
+        with self._cond:
+            bucket = self.bucket(provider)
+            if bucket is None:
+                return
+            waiting = self._waiting.setdefault(provider, [0] * len(Priority))
+            waiting[level] += 1
+            deadline = time.monotonic() + self.INTERACTIVE_MAX_WAIT_SEC
+            try:
+                while True:
+                    if any(waiting[:level]):
+                        wait = None  # ждём, пока более важные запросы пройдут
+                    else:
+                        wait = bucket.try_acquire(self.RESERVE[level] * bucket.burst)
+                        if wait == 0.0:
+                            return
+                    if level == Priority.INTERACTIVE:
+                        wait = min(wait, deadline - time.monotonic())
+                        if wait <= 0:
+                            return
+                    self._cond.wait(wait)
+            finally:
+                waiting[level] -= 1
+                self._cond.notify_all()
+
+    def penalize(self, provider: str, retry_after: float):
+        """Провайдер ответил 429: притормозить все запросы к нему"""
+        logger.warning(f"{provider}: превышен лимит запросов, пауза {retry_after:.1f} с")
+        with self._cond:
+            bucket = self.bucket(provider)
+            if bucket is not None:
+                bucket.penalize(retry_after)
+
+    def call(self, provider: str, func, *args, **kwargs):
+        level = _request_priority.get()
+        self._acquire(provider, level)
+        bucket = self.bucket(provider)
+        penalties = bucket.penalties if bucket else 0
+        result = func(*args, **kwargs)
+        if bucket is not None and bucket.penalties == penalties:
+            with self._cond:
+                bucket.reward()
+        return result
+
+    def wrap(self, provider: str, api: AbstractMusicAPI) -> "ScheduledAPI":
+        if isinstance(api, ScheduledAPI):
+            return api
+        return ScheduledAPI(api, provider, self)
+
+
+class ScheduledAPI:
+    """Прокси провайдера: каждый вызов метода проходит через планировщик"""
+
+    def __init__(self, api: AbstractMusicAPI, provider: str, scheduler: RequestScheduler):
+        self._api = api
+        self._provider = provider
+        self._scheduler = scheduler
+        api.on_rate_limited = lambda retry_after: scheduler.penalize(provider, retry_after)
+
+    def __getattr__(self, name):
+        attr = getattr(self._api, name)
+        if name.startswith("_") or name == "report_error" or not callable(attr):
+            return attr
+
+        def scheduled(*args, **kwargs):
+            return self._scheduler.call(self._provider, attr, *args, **kwargs)
+        return scheduled
+
+# ======= Скробблинг Last.fm =======
+
+class ScrobbleJournal:
+    """Очередь скробблов на диске: строки JSON {"op": "add", ...} и
+    {"op": "ack", "ids": [...]}. Каждая запись сбрасывается на диск до
+    возврата, поэтому прослушивания не теряются при падении или без сети.
+    id скроббла — (время начала, исполнитель, название): по этому ключу
+    Last.fm отбрасывает повтор, если подтверждение не успело записаться."""
+
+    COMPACT_BYTES = 64 * 1024
+
+    def __init__(self, path: Path = CACHE_DIR / "scrobbles.jsonl"):
+        self.path = path
+        self.pending = {}  # id -> запись, в порядке добавления
+        try:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # строка, оборванная при сбое
+                    if entry.get("op") == "add":
+                        if self.valid(entry):
+                            self.pending[entry["id"]] = entry
+                    elif entry.get("op") == "ack":
+                        for scrobble_id in entry["ids"]:
+                            self.pending.pop(scrobble_id, None)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"Скробблинг: не удалось прочитать журнал: {e}")
+
+    def _write(self, entry: dict):
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            logger.error(f"Скробблинг: ошибка записи журнала: {e}")
+
+    @staticmethod
+    def valid(entry: dict) -> bool:
+        # Без исполнителя или названия Last.fm отвергнет скроббл
+        return bool(entry.get("artist") and entry.get("title"))
+
+    def add(self, artist: str, title: str, timestamp: int, duration: int, album: str = ""):
+        entry = {"op": "add", "id": f"{timestamp}|{artist}|{title}", "artist": artist,
+                 "title": title, "album": album, "timestamp": timestamp, "duration": duration}
+        if entry["id"] in self.pending or not self.valid(entry):
+            return
+        self._write(entry)
+        self.pending[entry["id"]] = entry
+
+    def batch(self, size: int) -> List[dict]:
+        return list(self.pending.values())[:size]
+
+    def ack(self, ids: List[str]):
+        self._write({"op": "ack", "ids": ids})
+        for scrobble_id in ids:
+            self.pending.pop(scrobble_id, None)
+        if not self.pending and self.path.stat().st_size > self.COMPACT_BYTES:
+            self.path.write_text("", encoding="utf-8")
+
+
+class Scrobbler(QObject):
+    """Следит за воспроизведением и складывает прослушивания в журнал,
+    отправляя его в Last.fm пачками в фоне. Без сети — экспоненциальная
+    пауза между попытками; воспроизведение никогда не ждёт сеть. Пачку,
+    отвергнутую Last.fm, отправляют по одному скробблу и отбрасывают
+    отвергнутые; при недействительной сессии отправка ждёт следующего
+    прослушивания."""
+
+    MIN_TRACK_SEC = 30     # правила Last.fm: трек длиннее 30 секунд,
+    MAX_LISTEN_SEC = 240   # прослушан наполовину или не меньше 4 минут
+    BATCH_SIZE = 50
+    FLUSH_DELAY_MS = 5000
+    BACKOFF_MIN_SEC = 30
+    BACKOFF_MAX_SEC = 3600
+
+    _flush_done = pyqtSignal(list, str)  # отправленные id, результат scrobble_many
+
+    def __init__(self, providers: "ProviderRegistry", core, parent=None):
+        super().__init__(parent)
+        self.providers = providers
+        self.journal = ScrobbleJournal()
+        self.failures = 0
+        self._sending = False
+        self.suspects = set()   # id из отвергнутых пачек: отправляются по одному
+
+        self.track = None
+        self.started_at = 0
+        self.listened = 0.0
+        self.playing_since = None
+        self.scrobbled = False
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.flush)
+        self._flush_done.connect(self._on_flush_done)
+
+        core.track_started.connect(self.on_track_started)
+        core.state_changed.connect(self.on_state_changed)
+        core.position_changed.connect(self.on_position_changed)
+
+        if self.journal.pending:
+            self.timer.start(self.FLUSH_DELAY_MS)
+
+    def _api(self):
+        api = self.providers.get("Last.fm")
+        return api if api is not None and api.can_scrobble else None
+
+    # ---- Учёт прослушивания ----
+
+    def on_track_started(self, index: int, track):
+        self.track = track.track if hasattr(track, 'track') else track
+        self.started_at = int(time.time())
+        self.listened = 0.0
+        self.playing_since = time.monotonic()
+        self.scrobbled = False
+
+    def on_state_changed(self, state: int):
+        now = time.monotonic()
+        if self.playing_since is not None:
+            self.listened += now - self.playing_since
+        self.playing_since = now if state == QMediaPlayer.PlayingState else None
+
+    def on_position_changed(self, position: int, duration: int):
+        if self.track is None or self.scrobbled:
+            return
+        duration_sec = (duration or self.track.duration_ms or 0) // 1000
+        listened = self.listened
+        if self.playing_since is not None:
+            listened += time.monotonic() - self.playing_since
+        if duration_sec < self.MIN_TRACK_SEC or listened < min(duration_sec / 2, self.MAX_LISTEN_SEC):
+            return
+        self.scrobbled = True
+        if self._api() is None:
+            return  # скробблинг не настроен
+        artists = getattr(self.track, 'artists', None) or []
+        albums = getattr(self.track, 'albums', None) or []
+        self.journal.add(artists[0].name if artists else "", self.track.title, self.started_at,
+                         duration_sec, getattr(albums[0], 'title', "") if albums else "")
+        if not self.timer.isActive() and not self._sending:
+            self.timer.start(self.FLUSH_DELAY_MS)
+
+    # ---- Отправка ----
+
+    def flush(self):
+        """Отправить очередную пачку из журнала в фоновом потоке"""
+        batch = self.journal.batch(self.BATCH_SIZE)
+        api = self._api()
+        if not batch or api is None or self._sending:
+            return
+        if batch[0]["id"] in self.suspects:
+            batch = batch[:1]
+        self._sending = True
+
+        def run():
+            with RequestScheduler.priority(Priority.BACKGROUND):
+                result = api.scrobble_many(batch)
+            self._flush_done.emit([entry["id"] for entry in batch], result)
+
+        threading.Thread(target=run, name="scrobble", daemon=True).start()
+
+    def _on_flush_done(self, ids: list, result: str):
+        self._sending = False
+        if result == "rejected" and len(ids) > 1:
+            # Какая-то запись испорчена — ищем её, отправляя по одной
+            self.suspects.update(ids)
+            self.timer.start(0)
+            return
+        if result == "rejected":
+            logger.error(f"Скробблинг: Last.fm отверг {self.journal.pending.get(ids[0])}, запись удалена")
+        elif result == "unauthorized":
+            logger.error("Скробблинг: сессия Last.fm недействительна, "
+                         "отправка отложена до следующего прослушивания")
+            return
+        elif result != "sent":
+            self.failures += 1
+            delay = min(self.BACKOFF_MIN_SEC * 2 ** (self.failures - 1), self.BACKOFF_MAX_SEC)
+            delay *= random.uniform(0.8, 1.2)
+            logger.warning(f"Скробблинг: {len(self.journal.pending)} в очереди, повтор через {delay:.0f} с")
+            self.timer.start(int(delay * 1000))
+            return
+        self.failures = 0
+        self.suspects.difference_update(ids)
+        self.journal.ack(ids)
+        if self.journal.pending:
+            self.timer.start(0)
+
+# ======= Потоковое воспроизведение через локальный кэширующий прокси =======
+
+class RangeSet:
+    """Скачанные байты: отсортированные непересекающиеся полуинтервалы [начало, конец)"""
+
+    def __init__(self, ranges=None):
+        self.ranges = []
+        for start, end in ranges or []:
+            self.add(start, end)
+
+    def add(self, start: int, end: int):
+        merged = []
+        for s, e in self.ranges:
+            if e < start or s > end:
+                merged.append([s, e])
+            else:
+                start, end = min(s, start), max(e, end)
+        merged.append([start, end])
+        self.ranges = sorted(merged)
+
+    def contiguous_end(self, pos: int) -> int:
+        """Конец скачанного куска, содержащего pos (или pos, если байта нет)"""
+        for s, e in self.ranges:
+            if s <= pos < e:
+                return e
+        return pos
+
+    def next_gap(self, pos: int, size: int) -> Optional[int]:
+        """Первый нескачанный байт начиная с pos, затем с начала файла; None — всё скачано"""
+        for start in (pos, 0):
+            while start < size:
+                end = self.contiguous_end(start)
+                if end == start:
+                    return start
+                start = end
+        return None
+
+
+class AudioCache:
+    """Локальный кэш аудио: готовые файлы (<ключ>.mp3 и т. п.) и недокачанные
+    разрежённые файлы в partial/ со списком скачанных диапазонов рядом.
+    Когда кэш превышает max_bytes, удаляются самые старые файлы — готовые
+    и недокачанные, кроме тех, что качаются сейчас."""
+
+    EXTENSIONS = {
+        "audio/mpeg": ".mp3",
+        "audio/mp4": ".m4a",
+        "audio/aac": ".aac",
+        "audio/ogg": ".ogg",
+        "audio/flac": ".flac",
+    }
+
+    def __init__(self, path: Path = CACHE_DIR / "audio", max_bytes: int = 2 * 1024 ** 3):
+        self.path = path
+        self.partial_dir = path / "partial"
+        self.max_bytes = max_bytes
+        self.partial_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._active = {}   # имя недокачанного файла -> число скачиваний, которые в него пишут
+
+    @staticmethod
+    def file_name(key: str) -> str:
+        return re.sub(r"[^\w.-]", "_", key)
+
+    def complete(self, key: str) -> Optional[Path]:
+        """Готовый файл трека (его время доступа обновляется для вытеснения)"""
+        for path in self.path.glob(self.file_name(key) + ".*"):
+            os.utime(path)
+            return path
+        return None
+
+    def partial(self, key: str):
+        name = self.file_name(key)
+        return self.partial_dir / (name + ".part"), self.partial_dir / (name + ".json")
+
+    def load_partial(self, key: str) -> Optional[dict]:
+        data_path, meta_path = self.partial(key)
+        try:
+            meta = json.loads(meta_path.read_text(encoding="utf-8"))
+            if data_path.stat().st_size >= max((e for s, e in meta["ranges"]), default=0):
+                return meta
+        except (OSError, ValueError, KeyError):
+            pass
+        return None
+
+    def save_partial(self, key: str, size: Optional[int], content_type: str, ranges: RangeSet):
+        _, meta_path = self.partial(key)
+        meta_path.write_text(json.dumps({"size": size, "type": content_type,
+                                         "ranges": ranges.ranges}), encoding="utf-8")
+
+    def promote(self, key: str, content_type: str) -> Path:
+        """Перенести полностью скачанный файл в кэш готовых"""
+        data_path, meta_path = self.partial(key)
+        target = self.path / (self.file_name(key) + self.EXTENSIONS.get(content_type, ".audio"))
+        os.replace(data_path, target)
+        meta_path.unlink(missing_ok=True)
+        self.evict()
+        return target
+
+    def set_active(self, key: str, active: bool):
+        """Отметить скачивание, чьи недокачанные файлы нельзя вытеснять"""
+        name = self.file_name(key)
+        with self._lock:
+            count = self._active.get(name, 0) + (1 if active else -1)
+            if count > 0:
+                self._active[name] = count
+            else:
+                self._active.pop(name, None)
+
+    @staticmethod
+    def _disk_usage(stat: os.stat_result) -> int:
+        # Недокачанные файлы разрежённые: считаем занятые блоки, а не длину
+        blocks = getattr(stat, "st_blocks", None)
+        return blocks * 512 if blocks is not None else stat.st_size
+
+    def evict(self):
+        with self._lock:
+            groups = {}   # (каталог, имя) -> [время изменения, размер, файлы]
+            for directory in (self.path, self.partial_dir):
+                for path in directory.iterdir():
+                    if directory is self.partial_dir and path.stem in self._active:
+                        continue
+                    try:
+                        stat = path.stat()
+                    except FileNotFoundError:
+                        continue
+                    if not path.is_file():
+                        continue
+                    # .part и .json одного трека удаляются вместе
+                    group = groups.setdefault((directory, path.stem), [0.0, 0, []])
+                    group[0] = max(group[0], stat.st_mtime)
+                    group[1] += self._disk_usage(stat)
+                    group[2].append(path)
+            total = sum(size for _, size, _ in groups.values())
+            if self._active:
+                for path in self.partial_dir.iterdir():
+                    if path.stem in self._active:
+                        try:
+                            total += self._disk_usage(path.stat())
+                        except FileNotFoundError:
+                            pass
+            for _, size, paths in sorted(groups.values(), key=lambda g: g[0]):
+                if total <= self.max_bytes:
+                    break
+                total -= size
+                for path in paths:
+                    path.unlink(missing_ok=True)
+
+
+class _StreamDownload:
+    """Скачивание одного трека в разрежённый файл. Фоновый поток заполняет
+    пропуски, начиная с места, которое сейчас читает плеер (после перемотки
+    вперёд — с новой позиции), затем докачивает оставшееся и переносит файл
+    в кэш готовых. Сбои сети переживаются повторами; плеер тем временем
+    читает уже скачанное."""
+
+    CHUNK = 64 * 1024
+    SEEK_TOLERANCE = 512 * 1024   # ближе этого дешевле докачать, чем переподключаться
+    SAVE_EVERY = 2 * 1024 * 1024
+    RETRIES = 5
+
+    def __init__(self, cache: AudioCache, key: str, url: str):
+        self.cache = cache
+        self.key = key
+        self.url = url
+        meta = cache.load_partial(key) or {}
+        self.size = meta.get("size")
+        self.content_type = meta.get("type", "audio/mpeg")
+        self.ranges = RangeSet(meta.get("ranges"))
+        data_path, _ = cache.partial(key)
+        cache.set_active(key, True)
+        self.fd = os.open(data_path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.cond = threading.Condition()
+        self.cursor = 0
+        self.error = None
+        self.done = False
+        self.closed = False
+        self._running = True
+        self._unsaved = 0
+        self.thread = threading.Thread(target=self._run, name=f"stream-{key}", daemon=True)
+        self.thread.start()
+
+    def wait_size(self, timeout: float) -> Optional[int]:
+        with self.cond:
+            self.cond.wait_for(lambda: self.size is not None or self.error or self.closed, timeout)
+            return self.size
+
+    def read(self, pos: int, limit: int, timeout: float) -> Optional[bytes]:
+        """Байты с позиции pos (не больше limit); ждёт докачки. None — сбой или таймаут"""
+        with self.cond:
+            if self.ranges.contiguous_end(pos) == pos:
+                self.cursor = pos
+                self.cond.notify_all()
+            if not self.cond.wait_for(lambda: self.ranges.contiguous_end(pos) > pos
+                                      or self.error or self.closed, timeout):
+                return None
+            available = self.ranges.contiguous_end(pos) - pos
+            if available <= 0 or self.closed:
+                return None
+            return os.pread(self.fd, min(available, limit), pos)
+
+    def close(self):
+        """Остановить скачивание, не дожидаясь потока (вызывается из GUI)"""
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify_all()
+            if not self.done:
+                self.cache.save_partial(self.key, self.size, self.content_type, self.ranges)
+            if not self._running:   # поток уже завершился — файл закрываем сами
+                os.close(self.fd)
+
+    def _run(self):
+        failures = 0
+        try:
+            while not self.closed:
+                with self.cond:
+                    start = self.ranges.next_gap(self.cursor, self.size) if self.size is not None \
+                        else self.cursor
+                if start is None:
+                    self._promote()
+                    return
+                try:
+                    self._fetch(start)
+                    failures = 0
+                except OSError as e:
+                    failures += 1
+                    if failures > self.RETRIES:
+                        raise
+                    logger.warning(f"Поток {self.key}: {e}, повтор {failures}/{self.RETRIES}")
+                    time.sleep(min(2 ** (failures - 1), 30))
+        except Exception as e:
+            logger.error(f"Поток {self.key}: не удалось скачать: {e}")
+            with self.cond:
+                self.error = str(e)
+                self.cond.notify_all()
+        finally:
+            with self.cond:
+                if not self.done:
+                    self.cache.save_partial(self.key, self.size, self.content_type, self.ranges)
+                self._running = False
+                if self.closed:
+                    os.close(self.fd)
+            self.cache.set_active(self.key, False)
+            if not self.done:
+                self.cache.evict()   # недокачанный файл тоже занимает место
+
+    def _fetch(self, start: int):
+        """Качать с позиции start одним запросом, пока не упрёмся в скачанное
+        или плееру не понадобится другое место"""
+        request = urllib.request.Request(self.url, headers={"Range": f"bytes={start}-"})
+        with urllib.request.urlopen(request, timeout=15) as response:
+            content_range = response.headers.get("Content-Range", "")
+            if response.status == 206 and "/" in content_range:
+                size = content_range.rsplit("/", 1)[1]
+            else:
+                start, size = 0, response.headers.get("Content-Length")  # сервер не умеет Range
+            if not size or not size.isdigit():
+                raise ValueError("сервер не сообщил размер файла")
+            with self.cond:
+                self.size = int(size)
+                self.content_type = response.headers.get_content_type()
+                self.cond.notify_all()
+
+            pos = start
+            while not self.closed:
+                data = response.read(self.CHUNK)
+                if not data:
+                    if pos == start:
+                        raise ConnectionError("источник оборвал ответ")
+                    return
+                with self.cond:
+                    if self.closed:
+                        return
+                    os.pwrite(self.fd, data, pos)
+                    self.ranges.add(pos, pos + len(data))
+                    pos += len(data)
+                    self.cond.notify_all()
+                    seek = self.ranges.contiguous_end(self.cursor) == self.cursor and \
+                        not pos <= self.cursor < pos + self.SEEK_TOLERANCE
+                    self._unsaved += len(data)
+                    if self._unsaved >= self.SAVE_EVERY:
+                        self._unsaved = 0
+                        self.cache.save_partial(self.key, self.size, self.content_type, self.ranges)
+                if seek or self.ranges.contiguous_end(pos) > pos or pos >= self.size:
+                    return
+
+    def _promote(self):
+        with self.cond:
+            self.done = True
+        path = self.cache.promote(self.key, self.content_type)
+        logger.info(f"Трек {self.key} скачан целиком: {path}")
+
+
+class _StreamProxyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        download = self.server.owner.streams.get(self.path.lstrip("/"))
+        size = download.wait_size(timeout=20) if download else None
+        if size is None:
+            self.send_error(404 if download is None else 502)
+            return
+
+        start, end = 0, size
+        match = re.match(r"bytes=(\d*)-(\d*)", self.headers.get("Range", ""))
+        if match and match.group(1):
+            start = int(match.group(1))
+            end = min(int(match.group(2)) + 1, size) if match.group(2) else size
+        elif match and match.group(2):
+            start = max(size - int(match.group(2)), 0)   # последние N байт
+        if start >= size:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self.send_response(206 if match else 200)
+        self.send_header("Content-Type", download.content_type)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start))
+        if match:
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{size}")
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+
+        pos = start
+        try:
+            while pos < end:
+                data = download.read(pos, min(download.CHUNK, end - pos), timeout=30)
+                if not data:
+                    self.close_connection = True
+                    return
+                self.wfile.write(data)
+                pos += len(data)
+        except OSError:
+            self.close_connection = True  # плеер закрыл соединение (перемотка, смена трека)
+
+    do_HEAD = do_GET
+
+    def log_message(self, format, *args):
+        logger.debug("Прокси: " + format % args)
+
+
+class StreamingProxy:
+    """Локальный HTTP-сервер, через который QMediaPlayer и движок кроссфейда
+    читают удалённые треки. Диапазоны отдаются из разрежённого файла на
+    диске, недостающие докачиваются у источника, поэтому перемотка назад и
+    повтор трека не скачивают байты заново. Уже скачанные треки PlayerCore
+    играет прямо из AudioCache, без прокси."""
+
+    KEEP_DOWNLOADS = 2   # текущий и следующий трек
+
+    def __init__(self, cache: AudioCache):
+        self.cache = cache
+        self.streams = {}   # путь на прокси -> _StreamDownload
+        self._lock = threading.Lock()
+        self._httpd = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def source(self, key: str, url: str) -> str:
+        """Адрес на прокси, по которому читается удалённый трек"""
+        with self._lock:
+            if self._httpd is None:
+                self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), _StreamProxyHandler)
+                self._httpd.daemon_threads = True
+                self._httpd.owner = self
+                threading.Thread(target=self._httpd.serve_forever, name="stream-proxy",
+                                 daemon=True).start()
+            name = AudioCache.file_name(key)
+            download = self.streams.pop(name, None)
+            if download is None or download.error or download.closed:
+                download = _StreamDownload(self.cache, key, url)
+            else:
+                download.url = url   # прямые ссылки истекают
+            self.streams[name] = download
+            stale = list(self.streams)[:-self.KEEP_DOWNLOADS]
+            stopped = [self.streams.pop(old) for old in stale]
+        for old in stopped:
+            old.close()
+        return f"{self.url}/{name}"
+
+    def stop(self):
+        with self._lock:
+            downloads, self.streams = list(self.streams.values()), {}
+            httpd, self._httpd = self._httpd, None
+        for download in downloads:
+            download.close()
+        if httpd is not None:
+            httpd.shutdown()
+            httpd.server_close()
+
+# ======= Ядро плеера: провайдеры, очередь, воспроизведение =======
+
+class ProviderRegistry:
+    """Доступные провайдеры и их авторизованные экземпляры.
+    Токены хранятся в QSettings под ключом <провайдер>_token; они читаются
+    при создании и меняются через set_token, так что фоновые потоки
+    QSettings не трогают."""
+
+    PROVIDERS = {
+        "Yandex": YandexMusicAPI,
+        "Spotify": SpotifyMusicAPI,
+        "Last.fm": LastFMMusicAPI,
+        "SoundCloud": SoundCloudMusicAPI,
+        "Local": LocalFilesMusicAPI,
+    }
+
+    def __init__(self, settings: QSettings):
+        self.settings = settings
+        self.apis = {}  # имя -> авторизованный экземпляр API (через планировщик)
+        self.scheduler = RequestScheduler()
+        self.resolver = TrackResolver(self.get)
+        self._lock = threading.Lock()
+        self._auth_locks = {name: threading.Lock() for name in self.PROVIDERS}
+        self._tokens = {name: self.settings.value(f"{name.lower()}_token", "") for name in self.PROVIDERS}
+
+    def token(self, name: str) -> str:
+        return self._tokens.get(name, "")
+
+    def set_token(self, name: str, token: str):
+        self.settings.setValue(f"{name.lower()}_token", token)
+        self._tokens[name] = token
+
+    def create(self, name: str):
+        """Новый экземпляр провайдера, вызовы которого идут через планировщик"""
+        return self.scheduler.wrap(name, self.PROVIDERS[name]())
+
+    def register(self, name: str, api):
+        with self._lock:
+            self.apis[name] = self.scheduler.wrap(name, api)
+
+    def get(self, name: str):
+        """Экземпляр провайдера с сохранённым токеном или None.
+        Может вызываться из фоновых потоков; провайдер авторизуется один раз."""
+        api = self.apis.get(name)
+        if api is not None:
+            return api
+        token = self.token(name)
+        if not token or name not in self.PROVIDERS:
+            return None
+        with self._auth_locks[name]:
+            api = self.apis.get(name)
+            if api is not None:
+                return api   # пока ждали, авторизовал другой поток
+            api = self.create(name)
+            if not api.authenticate(token):
+                return None
+            with self._lock:
+                return self.apis.setdefault(name, api)
+
+    def playable_track(self, track):
+        """Воспроизводимая версия трека из снимка сессии или Last.fm, либо None"""
+        if isinstance(track, SnapshotTrack) and track.provider not in ("Last.fm", None):
+            api = self.get(track.provider)
+            found = api.get_tracks_by_ids([track.id]) if api else []
+            return found[0] if found else None
+        return self.resolver.resolve([track]).get(0)
+
+
+class PlayerCore(QObject):
+    """Очередь и воспроизведение без виджетов. Используется главным окном
+    и фоновым демоном; о состоянии сообщает сигналами."""
+
+    state_changed = pyqtSignal(int)
+    position_changed = pyqtSignal(int, int)   # позиция и длительность, мс
+    track_started = pyqtSignal(int, object)   # индекс в очереди, трек
+    error = pyqtSignal(str)
+
+    _prepared = pyqtSignal(int, object, object, object)   # номер запроса, исходный трек, воспроизводимый, источник
+    _next_prepared = pyqtSignal(int, object, str)         # номер запроса, следующий трек, источник
+
+    def __init__(self, providers: ProviderRegistry, settings: QSettings, parent=None):
+        super().__init__(parent)
+        self.providers = providers
+        self.settings = settings
+        self._play_request = 0   # последний запрос воспроизведения; старые результаты отбрасываются
+        self._next_request = 0
+        self._prepared.connect(self._on_prepared)
+        self._next_prepared.connect(self._on_next_prepared)
+
+        self.queue = []
+        self.visible = []
+        self.current_index = 0
+        self.current_duration_ms = 0
+
+        # Снимок прошлой сессии читается до любых сетевых запросов
+        self.session = SessionJournal()
+        self.restored_session = self.session.load()
+        self.resume_track = None
+        self.resume_position_ms = 0
+        self.session_timer = QTimer(self)
+        self.session_timer.setSingleShot(True)
+        self.session_timer.setInterval(500)
+        self.session_timer.timeout.connect(self.save_session_lists)
+
+        self.player = QMediaPlayer(self)
+
+        # Необязательный движок кроссфейда вместо QMediaPlayer
+        self.mixer = None
+        self.mixer_next = None   # (источник, трек), переданные движку как следующие
+        if settings.value("crossfade/enabled", False, type=bool):
+            if np is None:
+                logger.warning("Кроссфейд недоступен: установите numpy (pip install numpy)")
+            else:
+                self.mixer = CrossfadeEngine(
+                    int(settings.value("crossfade/duration_ms", 6000)),
+                    settings.value("crossfade/curve", "equal_power"),
+                    self)
+                self.mixer.track_changed.connect(self.on_mixer_track_changed)
+        self.output = self.mixer or self.player
+
+        self.output.stateChanged.connect(self.state_changed)
+        self.output.positionChanged.connect(self.on_position_changed)
+        self.output.setVolume(int(settings.value("volume", 50)))
+
+        self.scrobbler = Scrobbler(providers, self, self)
+        self.history = PlayHistory()
+        self.track_started.connect(lambda index, track: self.history.played(track))
+        self.audio_cache = AudioCache(max_bytes=int(settings.value("cache/audio_max_mb", 2048)) * 1024 ** 2)
+        self.stream_proxy = StreamingProxy(self.audio_cache)
+        QCoreApplication.instance().aboutToQuit.connect(self.shutdown)
+
+    # ---- Очередь ----
+
+    def restore(self):
+        """Восстановить очередь из снимка прошлой сессии. Возвращает видимый
+        список треков (это сама очередь, если он не сохранялся отдельно)"""
+        state = self.restored_session
+        self.queue = [SnapshotTrack(r) for r in state.get("queue") or []]
+        if state.get("visible") is None:
+            self.visible = self.queue
+        else:
+            self.visible = [SnapshotTrack(r) for r in state["visible"]]
+        if self.queue:
+            self.current_index = min(max(state.get("index", 0), 0), len(self.queue) - 1)
+            self.resume_track = self.queue[self.current_index]
+            self.resume_position_ms = state.get("position_ms", 0)
+            self.current_duration_ms = self.resume_track.duration_ms
+        return self.visible
+
+    def set_queue(self, tracks, visible=None):
+        """Заменить очередь; visible — список, показанный пользователю"""
+        self.queue = tracks
+        self.visible = tracks if visible is None else visible
+        self.session_timer.start()  # частые изменения склеиваются в одну запись
+
+    def save_session_lists(self):
+        self.session.set_lists(self.queue, self.visible)
+
+    # ---- Воспроизведение ----
+
+    def play_track(self, track) -> bool:
+        """Воспроизвести трек (объект провайдера, Last.fm или из снимка сессии).
+        Сопоставление трека без аудио и получение ссылки идут в фоне, поэтому
+        ни интерфейс, ни демон не ждут сеть; воспроизведение начнётся, когда
+        всё будет готово, об ошибках сообщит сигнал error"""
+        self._play_request += 1
+        request = self._play_request
+
+        def run():
+            found, url = track, None
+            try:
+                if isinstance(track, (LastFmTrack, SnapshotTrack)):
+                    found = self.providers.playable_track(track)
+                if found is not None:
+                    url = self.track_source(found)
+            except Exception as e:
+                logger.error(f"Ошибка подготовки трека: {e}")
+                url = e
+            self._prepared.emit(request, track, found, url)
+
+        threading.Thread(target=run, name="play-prepare", daemon=True).start()
+        return True
+
+    def _on_prepared(self, request: int, original, track, url):
+        if request != self._play_request:
+            return  # пока готовили, выбрали другой трек
+        if track is None:
+            self.error.emit("Не найдена воспроизводимая версия трека")
+            return
+        if isinstance(url, Exception):
+            self.error.emit(f"Ошибка воспроизведения: {url}")
+            return
+        if track is not original:
+            for i, pl_track in enumerate(self.queue):
+                if pl_track is original:
+                    self.queue[i] = track
+        self._start(original, track, url)
+
+    def _start(self, original, track, url: Optional[str]):
+        """Начать воспроизведение подготовленного трека"""
+        try:
+            # Найти индекс в текущем плейлисте
+            for i, pl_track in enumerate(self.queue):
+                if hasattr(pl_track, 'track'):
+                    pl_track = pl_track.track
+                if pl_track.id == track.id:
+                    self.current_index = i
+                    break
+            
+            if not url:
+                self.error.emit("Не удалось получить ссылку на трек")
+                return
+            self.current_duration_ms = track.duration_ms or 0
+            # Продолжить с места остановки прошлой сессии (движок кроссфейда не умеет перемотку)
+            start = self.resume_position_ms if original is self.resume_track and not self.mixer else 0
+            if self.mixer:
+                self.mixer.play_source(url)
+                self.queue_next_in_mixer()
+            else:
+                self.player.setMedia(QMediaContent(QUrl.fromLocalFile(url) if os.path.isabs(url) else QUrl(url)))
+                self.player.play()
+                if start:
+                    self.player.setPosition(start)
+            self.resume_track = None
+            self.resume_position_ms = 0
+            self.session.set_position(self.current_index, start)
+            self.track_started.emit(self.current_index, track)
+        except Exception as e:
+            self.error.emit(f"Ошибка воспроизведения: {e}")
+
+    def track_source(self, track) -> Optional[str]:
+        """Откуда играть трек: файл из кэша, адрес на локальном прокси или
+        ссылка как есть (локальные файлы); None — ссылку получить не удалось.
+        Ходит в сеть — вызывается из фоновых потоков"""
+        key = track_key(track)
+        path = self.audio_cache.complete(key)
+        if path is not None:
+            return str(path)
+        download_info = track.get_download_info()
+        if not download_info:
+            return None
+        url = download_info[0].get_direct_link()
+        if not url.startswith(("http://", "https://")):
+            return url
+        return self.stream_proxy.source(key, url)
+
+    def play_index(self, index: int) -> bool:
+        if not 0 <= index < len(self.queue):
+            self.error.emit(f"Нет трека с индексом {index}")
+            return False
+        self.current_index = index
+        track = self.queue[index]
+        return self.play_track(track.track if hasattr(track, 'track') else track)
+
+    def play(self):
+        """Продолжить воспроизведение или начать текущий трек очереди"""
+        nothing_loaded = self.mixer is not None or self.player.mediaStatus() == QMediaPlayer.NoMedia
+        if self.output.state() == QMediaPlayer.StoppedState and nothing_loaded:
+            # После восстановления сессии трек ещё не загружен
+            if self.current_index < len(self.queue):
+                self.play_index(self.current_index)
+            return
+        self.output.play()
+
+    def pause(self):
+        self.output.pause()
+
+    def stop(self):
+        self.output.stop()
+
+    def toggle_playback(self):
+        """Переключить воспроизведение/паузу"""
+        if self.output.state() == QMediaPlayer.PlayingState:
+            self.pause()
+        else:
+            self.play()
+
+    def prev_track(self):
+        """Предыдущий трек"""
+        if self.queue and self.current_index > 0:
+            self.play_index(self.current_index - 1)
+
+    def next_track(self):
+        """Следующий трек"""
+        if self.queue and self.current_index < len(self.queue) - 1:
+            self.play_index(self.current_index + 1)
+
+    def queue_next_in_mixer(self):
+        """Передать движку кроссфейда следующий трек очереди"""
+        self.mixer_next = None
+        self._next_request += 1
+        next_index = self.current_index + 1
+        if next_index >= len(self.queue):
+            self.mixer.queue_next("")
+            return
+        track = self.queue[next_index]
+        if hasattr(track, 'track'):
+            track = track.track
+        request = self._next_request
+
+        def run():
+            try:
+                with RequestScheduler.priority(Priority.PREFETCH):
+                    source = self.track_source(track) or ""
+            except Exception as e:
+                logger.error(f"Не удалось подготовить следующий трек: {e}")
+                source = ""
+            self._next_prepared.emit(request, track, source)
+
+        threading.Thread(target=run, name="mixer-next", daemon=True).start()
+
+    def _on_next_prepared(self, request: int, track, source: str):
+        if request != self._next_request:
+            return  # очередь или текущий трек успели смениться
+        self.mixer_next = (source, track) if source else None
+        self.mixer.queue_next(source)
+
+    def on_mixer_track_changed(self, source: str):
+        """Движок сам перешёл к следующему треку — тому, что был ему передан,
+        даже если очередь с тех пор заменили"""
+        queued_source, track = self.mixer_next or ("", None)
+        self.mixer_next = None
+        if track is None or source != queued_source:
+            logger.warning(f"Движок перешёл к неизвестному треку: {source}")
+            return
+        key = track_key(track)
+        rows = [pl.track if hasattr(pl, 'track') else pl for pl in self.queue]
+        for i, pl_track in enumerate(rows):
+            if pl_track is track:
+                self.current_index = i
+                break
+        else:
+            # Очередь заменили: найти тот же трек по ключу, иначе остаться в её пределах
+            found = [i for i, pl_track in enumerate(rows) if track_key(pl_track) == key]
+            self.current_index = found[0] if found else min(self.current_index, max(len(rows) - 1, 0))
+        self.current_duration_ms = track.duration_ms or 0
+        self.track_started.emit(self.current_index, track)
+        self.queue_next_in_mixer()
+
+    def on_position_changed(self, position: int):
+        self.session.set_position(self.current_index, position)
+        self.position_changed.emit(position, self.output.duration() or self.current_duration_ms)
+
+    def state(self) -> int:
+        return self.output.state()
+
+    def volume(self) -> int:
+        return self.output.volume()
+
+    def setVolume(self, volume: int):
+        self.output.setVolume(volume)
+
+    def status(self) -> dict:
+        track = self.queue[self.current_index] if self.current_index < len(self.queue) else None
+        return {
+            "state": self.output.state(),
+            "index": self.current_index,
+            "position_ms": self.output.position() or self.resume_position_ms,
+            "duration_ms": self.output.duration() or self.current_duration_ms,
+            "volume": self.output.volume(),
+            "track": SnapshotTrack.record(track) if track is not None else None,
+        }
+
+    def shutdown(self):
+        self.settings.setValue("volume", self.output.volume())
+        if self.session_timer.isActive():
+            self.save_session_lists()
+        self.session.compact()
+        if self.mixer:
+            self.mixer.shutdown()
+        self.stream_proxy.stop()   # недокачанные диапазоны сохраняются до следующего раза
+
+# ======= Синхронизация библиотеки по ревизиям =======
+
+class LibrarySync(QObject):
+    """Фоновая дельта-синхронизация понравившихся треков и открытых ранее
+    плейлистов по ревизиям сервера. Локальная копия хранится на диске;
+    если ревизия не менялась, синхронизация — один короткий запрос,
+    иначе догружаются только новые треки."""
+
+    collection_updated = pyqtSignal(str, list)   # ключ коллекции, новый список треков
+    finished = pyqtSignal()
+
+    INTERVAL_MS = 5 * 60 * 1000
+    FETCH_BATCH = 200
+
+    def __init__(self, providers: ProviderRegistry, path: Path = CACHE_DIR / "library.json", parent=None):
+        super().__init__(parent)
+        self.providers = providers
+        self.path = path
+        self.objects = {}   # id -> полноценный объект трека из последних загрузок
+        self._lock = threading.Lock()
+        self._running = False
+        self.generation = 0   # растёт при каждом изменении коллекций
+        # ключ ("liked" или "playlist:<kind>") -> {"revision": int, "tracks": [записи SnapshotTrack]}
+        self.collections = {}
+        try:
+            self.collections = json.loads(path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Локальная библиотека повреждена, будет загружена заново: {e}")
+
+        self.timer = QTimer(self)
+        self.timer.setInterval(self.INTERVAL_MS)
+        self.timer.timeout.connect(self.start)
+        self.timer.start()
+
+    def revision(self, key: str) -> Optional[int]:
+        collection = self.collections.get(key)
+        return collection["revision"] if collection else None
+
+    def tracks(self, key: str) -> list:
+        """Треки коллекции из локальной копии (без сети)"""
+        records = self.collections.get(key, {}).get("tracks", [])
+        return [self.objects.get(str(r["i"])) or SnapshotTrack(r) for r in records]
+
+    def remember(self, key: str, revision: int, tracks):
+        """Сохранить коллекцию, загруженную целиком в обход синхронизации"""
+        records = []
+        for track in tracks:
+            if hasattr(track, 'track'):
+                track = track.track
+            self.objects[str(track.id)] = track
+            records.append(SnapshotTrack.record(track))
+        with self._lock:
+            self.collections[key] = {"revision": revision, "tracks": records}
+            self.generation += 1
+        self._save()
+
+    def start(self):
+        """Запустить синхронизацию в фоне (если ещё не идёт)"""
+        api = self.providers.apis.get("Yandex")
+        if self._running or api is None or not api.supports_revisions:
+            return
+        self._running = True
+        threading.Thread(target=self._run, args=(api,), name="library-sync", daemon=True).start()
+
+    def _run(self, api):
+        try:
+            with RequestScheduler.priority(Priority.BACKGROUND):
+                changed = False
+                result = api.get_liked_track_ids(self.revision("liked") or 0)
+                if result:
+                    changed |= self._apply(api, "liked", *result)
+                # Плейлисты синхронизируются, только если их уже открывали
+                known = any(key.startswith("playlist:") for key in self.collections)
+                for kind, revision in (api.get_playlist_revisions() if known else {}).items():
+                    key = f"playlist:{kind}"
+                    if key not in self.collections or self.revision(key) == revision:
+                        continue
+                    result = api.get_playlist_track_ids(kind)
+                    if result:
+                        changed |= self._apply(api, key, *result)
+                if changed:
+                    self._save()
+        except Exception as e:
+            logger.error(f"Ошибка синхронизации библиотеки: {e}")
+        finally:
+            self._running = False
+            self.finished.emit()
+
+    def _apply(self, api, key: str, revision: int, ids: List[str]) -> bool:
+        old = {str(r["i"]): r for r in self.collections.get(key, {}).get("tracks", [])}
+        missing = [i for i in ids if i not in old and i not in self.objects]
+        for start in range(0, len(missing), self.FETCH_BATCH):
+            for track in api.get_tracks_by_ids(missing[start:start + self.FETCH_BATCH]):
+                self.objects[str(track.id)] = track
+
+        records, tracks = [], []
+        for track_id in ids:
+            track = self.objects.get(track_id)
+            if track is not None:
+                record = SnapshotTrack.record(track)
+            elif track_id in old:
+                record = old[track_id]
+                track = SnapshotTrack(record)
+            else:
+                continue  # трек недоступен в каталоге
+            records.append(record)
+            tracks.append(track)
+
+        with self._lock:
+            self.collections[key] = {"revision": revision, "tracks": records}
+            self.generation += 1
+        removed = len(set(old) - set(ids))
+        logger.info(f"Синхронизация {key}: ревизия {revision}, +{len(missing)} / -{removed}")
+        self.collection_updated.emit(key, tracks)
+        return True
+
+    def snapshot(self) -> dict:
+        """Копия коллекций для чтения вне потока синхронизации"""
+        with self._lock:
+            return dict(self.collections)
+
+    def _save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        # Запись и замена под одной блокировкой: сохраняют и GUI, и поток синхронизации
+        with self._lock:
+            tmp.write_text(json.dumps(self.collections, ensure_ascii=False, separators=(",", ":")),
+                           encoding="utf-8")
+            os.replace(tmp, self.path)
+
+# ======= Умные плейлисты по локальной библиотеке =======
+
+def track_key(track) -> str:
+    """Ключ трека, общий для библиотеки и истории: <провайдер>:<id>"""
+    if hasattr(track, 'track'):
+        track = track.track
+    return f"{track_provider(track)}:{track.id}"
+
+
+class PlayHistory:
+    """История прослушиваний: журнал JSONL, дописываемый при старте трека.
+    Читатель (интерфейс при подключении к демону) подхватывает только
+    новые строки; при разрастании журнал сворачивается в итоги."""
+
+    COMPACT_BYTES = 4 * 1024 * 1024
+
+    def __init__(self, path: Path = CACHE_DIR / "history.jsonl"):
+        self.path = path
+        self.plays = {}    # ключ трека -> [время последнего прослушивания, число прослушиваний]
+        self.version = 0   # растёт при каждом изменении
+        self._offset = 0
+        self.refresh()
+
+    def refresh(self):
+        """Дочитать записи, добавленные другим процессом"""
+        try:
+            size = self.path.stat().st_size
+        except FileNotFoundError:
+            return
+        if size < self._offset:   # журнал свернули — перечитать целиком
+            self.plays, self._offset = {}, 0
+        if size == self._offset:
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self._offset)
+            data = f.read(size - self._offset)
+        end = data.rfind(b"\n") + 1   # незаконченную строку дочитаем в следующий раз
+        for line in data[:end].splitlines():
+            try:
+                entry = json.loads(line)
+                self._apply(entry["k"], entry["t"], entry.get("n", 1))
+            except (ValueError, KeyError):
+                continue
+        self._offset += end
+        self.version += 1
+
+    def _apply(self, key: str, timestamp: float, count: int):
+        last, plays = self.plays.get(key, (0, 0))
+        self.plays[key] = [max(last, timestamp), plays + count]
+
+    def played(self, track):
+        key = track_key(track)
+        now = int(time.time())
+        self.refresh()
+        self._apply(key, now, 1)
+        self.version += 1
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"k": key, "t": now}, ensure_ascii=False) + "\n")
+            self._offset = self.path.stat().st_size
+            if self._offset > self.COMPACT_BYTES:
+                self.compact()
+        except OSError as e:
+            logger.error(f"История прослушиваний: ошибка записи: {e}")
+
+    def compact(self):
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            for key, (last, count) in self.plays.items():
+                f.write(json.dumps({"k": key, "t": last, "n": count}, ensure_ascii=False) + "\n")
+        os.replace(tmp, self.path)
+        self._offset = self.path.stat().st_size
+
+
+class LibraryIndex:
+    """Колоночный снимок библиотеки (все синхронизированные коллекции без
+    повторов) и истории прослушиваний. Правило умного плейлиста — это
+    конъюнкция условий, каждое из которых — векторная операция над колонкой."""
+
+    SORTS = ("", "recent", "least_recent", "plays", "duration", "random")
+
+    def __init__(self, collections: dict, history: PlayHistory):
+        rows = {}          # ключ трека -> номер строки
+        self.records = []  # записи SnapshotTrack по строкам
+        members = {}       # коллекция -> номера строк
+        for name, collection in collections.items():
+            member_rows = []
+            for record in collection.get("tracks", []):
+                key = f"{record.get('p', 'Yandex')}:{record.get('i')}"
+                row = rows.get(key)
+                if row is None:
+                    row = rows[key] = len(self.records)
+                    self.records.append(record)
+                member_rows.append(row)
+            members[name] = member_rows
+
+        n = len(self.records)
+        self.rows = rows
+        self.keys = list(rows)
+        self.duration = np.fromiter((r.get("d") or 0 for r in self.records), np.float64, n) / 1000
+        self.titles = np.array([(r.get("t") or "").casefold() for r in self.records], dtype=str)
+        self.provider_names = sorted({r.get("p", "Yandex") for r in self.records})
+        provider_codes = {name: code for code, name in enumerate(self.provider_names)}
+        self.provider = np.fromiter((provider_codes[r.get("p", "Yandex")] for r in self.records),
+                                    np.int16, n)
+        self.membership = {}
+        for name, member_rows in members.items():
+            mask = np.zeros(n, bool)
+            mask[member_rows] = True
+            self.membership[name] = mask
+
+        # Исполнители: плоский список кодов и номер строки трека для каждого
+        self.artist_codes = {}   # нормализованное имя -> код
+        raw_codes = {}           # имя как в записи -> код
+        codes, owners = [], []
+        for row, record in enumerate(self.records):
+            for name in record.get("a", []):
+                code = raw_codes.get(name)
+                if code is None:
+                    code = raw_codes[name] = self.artist_codes.setdefault(
+                        normalize_text(name), len(self.artist_codes))
+                codes.append(code)
+                owners.append(row)
+        self.artist_ids = np.array(codes, np.int32)
+        self.artist_rows = np.array(owners, np.int64)
+
+        self.generation = None   # поколение LibrarySync, по которому построен индекс
+        self.history_version = None
+        self.refresh_history(history)
+
+    def refresh_history(self, history: PlayHistory):
+        if history.version == self.history_version:
+            return
+        n = len(self.records)
+        self.last_played = np.zeros(n, np.float64)
+        self.play_count = np.zeros(n, np.int32)
+        for key, (last, count) in history.plays.items():
+            row = self.rows.get(key)
+            if row is not None:
+                self.last_played[row] = last
+                self.play_count[row] = count
+        self.history_version = history.version
+
+    def _by_artists(self, names) -> "np.ndarray":
+        wanted = [self.artist_codes[n] for n in map(normalize_text, names) if n in self.artist_codes]
+        mask = np.zeros(len(self.records), bool)
+        mask[self.artist_rows[np.isin(self.artist_ids, wanted)]] = True
+        return mask
+
+    def query(self, rules: dict, now: Optional[float] = None) -> "np.ndarray":
+        """Номера строк, подходящих под правила, в нужном порядке.
+        Правила: collection, min_duration_sec, max_duration_sec, artists,
+        exclude_artists, title_contains, provider, not_played_days,
+        played_days, min_plays, max_plays, sort, limit."""
+        now = time.time() if now is None else now
+        n = len(self.records)
+        mask = np.ones(n, bool)
+        if rules.get("collection"):
+            mask &= self.membership.get(rules["collection"], np.zeros(n, bool))
+        if rules.get("min_duration_sec"):
+            mask &= self.duration >= rules["min_duration_sec"]
+        if rules.get("max_duration_sec"):
+            mask &= self.duration < rules["max_duration_sec"]
+        if rules.get("artists"):
+            mask &= self._by_artists(rules["artists"])
+        if rules.get("exclude_artists"):
+            mask &= ~self._by_artists(rules["exclude_artists"])
+        if rules.get("title_contains"):
+            mask &= np.char.find(self.titles, rules["title_contains"].casefold()) >= 0
+        if rules.get("provider"):
+            if rules["provider"] not in self.provider_names:
+                return np.zeros(0, np.int64)
+            mask &= self.provider == self.provider_names.index(rules["provider"])
+        if rules.get("not_played_days"):
+            mask &= self.last_played < now - rules["not_played_days"] * 86400
+        if rules.get("played_days"):
+            mask &= self.last_played >= now - rules["played_days"] * 86400
+        if rules.get("min_plays"):
+            mask &= self.play_count >= rules["min_plays"]
+        if rules.get("max_plays") is not None:
+            mask &= self.play_count <= rules["max_plays"]
+
+        rows = np.flatnonzero(mask)
+        sort = rules.get("sort", "")
+        if sort == "random":
+            rows = np.random.default_rng().permutation(rows)
+        elif sort:
+            column = {
+                "recent": -self.last_played,
+                "least_recent": self.last_played,
+                "plays": -self.play_count,
+                "duration": self.duration,
+            }[sort]
+            rows = rows[np.argsort(column[rows], kind="stable")]
+        if rules.get("limit"):
+            rows = rows[:rules["limit"]]
+        return rows
+
+
+class SmartPlaylists(QObject):
+    """Пользовательские умные плейлисты. Определения хранятся в QSettings
+    (smart_playlists, JSON), вычисляются по LibraryIndex и пересчитываются
+    после синхронизации библиотеки."""
+
+    changed = pyqtSignal()                   # список плейлистов изменился
+    collection_updated = pyqtSignal(str, list)  # "smart:<имя>", новый список треков
+
+    def __init__(self, library_sync: LibrarySync, history: PlayHistory,
+                 settings: QSettings, parent=None):
+        super().__init__(parent)
+        self.library_sync = library_sync
+        self.history = history
+        self.settings = settings
+        self._index = None
+        self._synced = set()   # коллекции, изменённые текущей синхронизацией
+        try:
+            self.playlists = json.loads(settings.value("smart_playlists", "{}"))
+        except ValueError:
+            self.playlists = {}
+        library_sync.collection_updated.connect(self.on_collection_updated)
+        library_sync.finished.connect(self.on_sync_finished)
+
+    def names(self) -> List[str]:
+        return sorted(self.playlists)
+
+    def rules(self, name: str) -> dict:
+        return self.playlists.get(name, {})
+
+    def save(self, name: str, rules: dict):
+        self.playlists[name] = rules
+        self._store()
+
+    def remove(self, name: str):
+        if self.playlists.pop(name, None) is not None:
+            self._store()
+
+    def _store(self):
+        self.settings.setValue("smart_playlists", json.dumps(self.playlists, ensure_ascii=False))
+        self.changed.emit()
+
+    def index(self) -> LibraryIndex:
+        if self._index is None or self._index.generation != self.library_sync.generation:
+            started = time.monotonic()
+            generation = self.library_sync.generation
+            self._index = LibraryIndex(self.library_sync.snapshot(), self.history)
+            self._index.generation = generation
+            logger.info(f"Индекс библиотеки: {len(self._index.records)} треков "
+                        f"за {(time.monotonic() - started) * 1000:.0f} мс")
+        self.history.refresh()
+        self._index.refresh_history(self.history)
+        return self._index
+
+    def tracks(self, name: str) -> list:
+        index = self.index()
+        objects = self.library_sync.objects
+        return [objects.get(str(index.records[row]["i"])) or SnapshotTrack(index.records[row])
+                for row in index.query(self.rules(name))]
+
+    def on_collection_updated(self, key: str, tracks: list):
+        self._synced.add(key)
+
+    def on_sync_finished(self):
+        """Синхронизация завершена — перестроить индекс один раз и обновить
+        плейлисты, которые зависят от изменившихся коллекций"""
+        if not self._synced:
+            return
+        synced, self._synced = self._synced, set()
+        for name, rules in self.playlists.items():
+            if rules.get("collection") in synced or not rules.get("collection"):
+                self.collection_updated.emit(f"smart:{name}", self.tracks(name))
+
+# ======= Фоновый режим: JSON-RPC через Unix-сокет =======
+
+DAEMON_SOCKET = Path(os.environ.get("XDG_RUNTIME_DIR") or CACHE_DIR) / "yandex-music-player.sock"
+
+
+class RpcServer(QObject):
+    """JSON-RPC 2.0 поверх QLocalServer, одно сообщение на строку.
+    Подключённым клиентам рассылаются уведомления player.state,
+    player.position и player.track.
+
+    play и queue.set не ждут сеть: ссылка на трек готовится в фоне
+    (PlayerCore.play_track), ошибки приходят уведомлением player.error."""
+
+    # Обработчик готовит работу в цикле событий и возвращает функцию,
+    # которая выполняется в фоновом потоке
+    BLOCKING_METHODS = {"search"}
+
+    _reply = pyqtSignal(object, object, object, object)  # сокет, id, результат, ошибка
+    _authenticated = pyqtSignal(str, object)             # провайдер, API, авторизованный в фоне
+
+    def __init__(self, core: PlayerCore, providers: ProviderRegistry,
+                 path: str = str(DAEMON_SOCKET), parent=None):
+        super().__init__(parent)
+        self.core = core
+        self.providers = providers
+        self.clients = []
+        self.methods = {
+            "status": self.core.status,
+            "play": self.rpc_play,
+            "pause": self.core.pause,
+            "toggle": self.core.toggle_playback,
+            "stop": self.core.stop,
+            "next": self.core.next_track,
+            "prev": self.core.prev_track,
+            "volume": self.rpc_volume,
+            "queue.get": self.rpc_queue_get,
+            "queue.set": self.rpc_queue_set,
+            "queue.add": self.rpc_queue_add,
+            "search": self.rpc_search,
+        }
+
+        self._reply.connect(self._send_reply)
+        self._authenticated.connect(self._on_authenticated)
+        core.state_changed.connect(lambda state: self.notify("player.state", {"state": state}))
+        core.position_changed.connect(lambda position, duration: self.notify(
+            "player.position", {"position_ms": position, "duration_ms": duration}))
+        core.track_started.connect(lambda index, track: self.notify(
+            "player.track", {"index": index, "track": SnapshotTrack.record(track)}))
+        core.error.connect(lambda message: self.notify("player.error", {"message": message}))
+
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        probe = QLocalSocket()
+        probe.connectToServer(path)
+        if probe.waitForConnected(500):
+            probe.disconnectFromServer()
+            raise OSError(f"Демон уже запущен: {path}")
+        QLocalServer.removeServer(path)  # никто не ответил — сокет остался после аварийного завершения
+        self.server = QLocalServer(self)
+        self.server.setSocketOptions(QLocalServer.UserAccessOption)
+        self.server.newConnection.connect(self._on_new_connection)
+        if not self.server.listen(path):
+            raise OSError(f"Не удалось открыть сокет {path}: {self.server.errorString()}")
+        logger.info(f"Демон: ожидание команд на {path}")
+
+    # ---- Методы ----
+
+    def rpc_play(self, index: Optional[int] = None):
+        if index is None:
+            self.core.play()
+            return True
+        return self.core.play_index(index)
+
+    def rpc_volume(self, value: Optional[int] = None):
+        if value is not None:
+            self.core.setVolume(int(value))
+        return self.core.volume()
+
+    def rpc_queue_get(self):
+        return {"index": self.core.current_index,
+                "tracks": [SnapshotTrack.record(t) for t in self.core.queue]}
+
+    def rpc_queue_set(self, tracks: list, index: int = 0, play: bool = False):
+        self.core.set_queue([SnapshotTrack(r) for r in tracks])
+        self.core.current_index = index
+        if play:
+            return self.core.play_index(index)
+        return True
+
+    def rpc_queue_add(self, tracks: list):
+        self.core.set_queue(self.core.queue + [SnapshotTrack(r) for r in tracks])
+        return len(self.core.queue)
+
+    def rpc_search(self, query: str, provider: Optional[str] = None):
+        # Провайдер и токен выбираются здесь: фоновый поток не трогает QSettings и реестр
+        name = provider or self.settings_provider()
+        api = self.providers.apis.get(name)
+        token = "" if api is not None else self.providers.token(name)
+        if api is None:
+            if not token or name not in ProviderRegistry.PROVIDERS:
+                raise ValueError(f"Провайдер {name} не авторизован")
+            api = self.providers.create(name)
+
+        def run():
+            if token:
+                if not api.authenticate(token):
+                    raise ValueError(f"Провайдер {name} не авторизован")
+                self._authenticated.emit(name, api)
+            return [SnapshotTrack.record(t) for t in api.search(query, 'track')]
+        return run
+
+    def _on_authenticated(self, name: str, api):
+        if name not in self.providers.apis:
+            self.providers.register(name, api)
+
+    def settings_provider(self) -> str:
+        return self.providers.settings.value("provider", "Yandex")
+
+    # ---- Транспорт ----
+
+    def _on_new_connection(self):
+        while self.server.hasPendingConnections():
+            sock = self.server.nextPendingConnection()
+            self.clients.append(sock)
+            sock.readyRead.connect(lambda s=sock: self._on_ready_read(s))
+            sock.disconnected.connect(lambda s=sock: self._on_disconnected(s))
+
+    def _on_disconnected(self, sock):
+        if sock in self.clients:
+            self.clients.remove(sock)
+        sock.deleteLater()
+
+    def _on_ready_read(self, sock):
+        while sock.canReadLine():
+            line = bytes(sock.readLine()).strip()
+            if line:
+                self._handle(sock, line)
+
+    def _handle(self, sock, line: bytes):
+        try:
+            request = json.loads(line)
+            method = request["method"]
+            params = request.get("params") or {}
+        except (ValueError, KeyError, TypeError):
+            self._send_reply(sock, None, None, {"code": -32700, "message": "Некорректный запрос"})
+            return
+        req_id = request.get("id")
+        handler = self.methods.get(method)
+        if handler is None:
+            self._send_reply(sock, req_id, None, {"code": -32601, "message": f"Неизвестный метод: {method}"})
+            return
+
+        result, error = self._call(handler, params)
+        if method in self.BLOCKING_METHODS and error is None:
+            def run():
+                self._reply.emit(sock, req_id, *self._call(result, {}))
+            threading.Thread(target=run, name=f"rpc-{method}", daemon=True).start()
+            return
+        self._send_reply(sock, req_id, result, error)
+
+    @staticmethod
+    def _call(handler, params):
+        try:
+            if isinstance(params, list):
+                return handler(*params), None
+            return handler(**params), None
+        except TypeError as e:
+            return None, {"code": -32602, "message": str(e)}
+        except Exception as e:
+            logger.error(f"Демон: ошибка обработки команды: {e}")
+            return None, {"code": -32000, "message": str(e)}
+
+    def _send_reply(self, sock, req_id, result, error):
+        if req_id is None and error is None:
+            return  # Уведомление от клиента — ответ не нужен
+        message = {"jsonrpc": "2.0", "id": req_id}
+        if error is not None:
+            message["error"] = error
+        else:
+            message["result"] = result
+        self._write(sock, message)
+
+    def notify(self, method: str, params: dict):
+        for sock in self.clients:
+            self._write(sock, {"jsonrpc": "2.0", "method": method, "params": params})
+
+    def _write(self, sock, message: dict):
+        if sock in self.clients and sock.state() == QLocalSocket.ConnectedState:
+            sock.write((json.dumps(message, ensure_ascii=False) + "\n").encode("utf-8"))
+
+
+class DaemonClient(QObject):
+    """Тонкий клиент демона для главного окна. Повторяет интерфейс PlayerCore,
+    но команды отправляет в сокет, а состояние получает уведомлениями."""
+
+    state_changed = pyqtSignal(int)
+    position_changed = pyqtSignal(int, int)
+    track_started = pyqtSignal(int, object)
+    error = pyqtSignal(str)
+
+    def __init__(self, path: str = str(DAEMON_SOCKET), parent=None):
+        super().__init__(parent)
+        self.queue = []
+        self.current_index = 0
+        self.current_duration_ms = 0
+        self.resume_position_ms = 0
+        self._state = QMediaPlayer.StoppedState
+        self._volume = 50
+        self._next_id = 1
+        self._callbacks = {}
+        self._waiting = set()   # id синхронных запросов
+        self._responses = {}
+
+        self.socket = QLocalSocket(self)
+        self.socket.readyRead.connect(self._on_ready_read)
+        self.socket.disconnected.connect(self._on_disconnected)
+        self.socket.connectToServer(path)
+        if not self.socket.waitForConnected(1000):
+            raise ConnectionError(f"Демон не запущен ({path}): {self.socket.errorString()}")
+
+        # Очередь отправляется отложенно, чтобы не гонять её при каждом изменении
+        self.queue_timer = QTimer(self)
+        self.queue_timer.setSingleShot(True)
+        self.queue_timer.setInterval(500)
+        self.queue_timer.timeout.connect(self._send_queue)
+
+    # ---- Транспорт ----
+
+    def call(self, method: str, params=None, callback=None) -> int:
+        req_id = self._next_id
+        self._next_id += 1
+        if callback is not None:
+            self._callbacks[req_id] = callback
+        message = {"jsonrpc": "2.0", "id": req_id, "method": method, "params": params or {}}
+        self.socket.write((json.dumps(message, ensure_ascii=False) + "\n").encode("utf-8"))
+        return req_id
+
+    def call_sync(self, method: str, params=None, timeout_ms: int = 3000):
+        req_id = self.call(method, params)
+        self._waiting.add(req_id)
+        self.socket.flush()
+        deadline = time.monotonic() + timeout_ms / 1000
+        while req_id not in self._responses and time.monotonic() < deadline:
+            if self.socket.waitForReadyRead(max(int((deadline - time.monotonic()) * 1000), 1)):
+                self._on_ready_read()
+        self._waiting.discard(req_id)
+        response = self._responses.pop(req_id, None)
+        if response is None:
+            raise TimeoutError(f"Демон не ответил на {method}")
+        if "error" in response:
+            raise RuntimeError(response["error"].get("message"))
+        return response.get("result")
+
+    def _on_ready_read(self):
+        while self.socket.canReadLine():
+            try:
+                message = json.loads(bytes(self.socket.readLine()))
+            except ValueError:
+                continue
+            if "method" in message:
+                self._on_notification(message["method"], message.get("params") or {})
+                continue
+            req_id = message.get("id")
+            if req_id in self._waiting:
+                self._responses[req_id] = message
+                continue
+            callback = self._callbacks.pop(req_id, None)
+            if "error" in message:
+                self.error.emit(message["error"].get("message", "Ошибка демона"))
+            elif callback is not None:
+                callback(message.get("result"))
+
+    def _on_disconnected(self):
+        self.error.emit("Соединение с демоном потеряно")
+
+    def _on_notification(self, method: str, params: dict):
+        if method == "player.state":
+            self._state = params["state"]
+            self.state_changed.emit(self._state)
+        elif method == "player.position":
+            self.position_changed.emit(params["position_ms"], params["duration_ms"])
+        elif method == "player.track":
+            self.current_index = params["index"]
+            track = SnapshotTrack(params["track"])
+            self.current_duration_ms = track.duration_ms
+            self.track_started.emit(self.current_index, track)
+        elif method == "player.error":
+            self.error.emit(params["message"])
+
+    # ---- Интерфейс PlayerCore ----
+
+    def restore(self):
+        """Забрать у демона текущую очередь и состояние"""
+        queue = self.call_sync("queue.get")
+        status = self.call_sync("status")
+        self.queue = [SnapshotTrack(r) for r in queue["tracks"]]
+        self.current_index = queue["index"]
+        self._state = status["state"]
+        self._volume = status["volume"]
+        self.resume_position_ms = status["position_ms"]
+        self.current_duration_ms = status["duration_ms"]
+        return self.queue
+
+    def set_queue(self, tracks, visible=None):
+        self.queue = tracks
+        self.queue_timer.start()
+
+    def _send_queue(self):
+        self.queue_timer.stop()
+        self.call("queue.set", {"tracks": [SnapshotTrack.record(t) for t in self.queue],
+                                "index": self.current_index})
+
+    def play_track(self, track) -> bool:
+        for i, pl_track in enumerate(self.queue):
+            if hasattr(pl_track, 'track'):
+                pl_track = pl_track.track
+            if pl_track is track or pl_track.id == track.id:
+                self.current_index = i
+                break
+        else:
+            self.queue = self.queue + [track]
+            self.current_index = len(self.queue) - 1
+            self.queue_timer.start()
+        # Демон должен знать актуальную очередь до команды play
+        if self.queue_timer.isActive():
+            self._send_queue()
+        self.call("play", {"index": self.current_index})
+        return True
+
+    def toggle_playback(self):
+        self.call("toggle")
+
+    def prev_track(self):
+        self.call("prev")
+
+    def next_track(self):
+        self.call("next")
+
+    def state(self) -> int:
+        return self._state
+
+    def volume(self) -> int:
+        return self._volume
+
+    def setVolume(self, volume: int):
+        self._volume = volume
+        self.call("volume", {"value": volume})
+
+# ======= Запись и воспроизведение HTTP-трафика провайдеров =======
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+try:
+    import httpx
 except ImportError:
-    soundcloud = None
+    httpx = None
 
+# Хосты API, обмены с которыми записываются и воспроизводятся
+PROVIDER_HOSTS = {
+    "api.music.yandex.net": "Yandex",
+    "api.spotify.com": "Spotify",
+    "accounts.spotify.com": "Spotify",
+    "api.soundcloud.com": "SoundCloud",
+    "api-v2.soundcloud.com": "SoundCloud",
+    "ws.audioscrobbler.com": "Last.fm",
+}
 
-class SoundCloudTrack:
-    def __init__(self, track_json):
-        from types import SimpleNamespace
-        self._json = track_json
-        self.id = track_json.get('id')
-        self.title = track_json.get('title')
-        self.duration_ms = track_json.get('duration', 0)
-        self.artists = [SimpleNamespace(name=track_json.get('user', {}).get('username', ''))]
-        self.stream_url = track_json.get('stream_url')
 
-    def get_download_info(self):
-        if self.stream_url:
-            # stream_url уже содержит client_id, если запрошено через /stream
-            return [SimpleNamespace(get_direct_link=lambda: self.stream_url)]
-        return []
+class HttpCassette:
+    """Записанные обмены с API провайдеров: JSONL, одна строка на запрос.
+    Секреты в параметрах заменяются на ***, заголовки запроса не сохраняются.
+    Запросы сопоставляются по методу, адресу и параметрам без секретов;
+    если точного совпадения нет — по «маршруту» (адрес и метод Last.fm)."""
 
+    SECRET_PARAMS = {"api_key", "api_sig", "sk", "client_id", "client_secret",
+                     "oauth_token", "access_token", "token", "session_key"}
+    KEPT_HEADERS = {"content-type", "retry-after"}
 
-class SoundCloudMusicAPI(AbstractMusicAPI):
-    """Работа с SoundCloud API. Нужен client_id (можно получить на dev.soundcloud.com)."""
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._exact = {}    # ключ -> [записи]
+        self._routes = {}   # маршрут -> [записи]
+        self._cursor = {}   # ключ -> номер следующей записи
+        self.providers = set()
+        if self.path.exists():
+            self.load()
 
-    def __init__(self):
-        self.client = None
+    @classmethod
+    def _scrub(cls, pairs):
+        return sorted((k, "***" if k.lower() in cls.SECRET_PARAMS else v) for k, v in pairs)
 
-    def authenticate(self, client_id: str) -> bool:
-        if soundcloud is None:
-            logger.error("Не установлена библиотека soundcloud (pip install soundcloud)")
-            return False
+    @classmethod
+    def _body_key(cls, body) -> str:
+        if not body:
+            return ""
+        if isinstance(body, str):
+            body = body.encode("utf-8")
         try:
-            self.client = soundcloud.Client(client_id=client_id)
-            logger.info("SoundCloud: клиент инициализирован")
-            return True
-        except Exception as e:
-            logger.error(f"SoundCloud: ошибка инициализации: {e}")
-            return False
+            pairs = parse_qsl(body.decode("utf-8"), keep_blank_values=True, strict_parsing=True)
+        except ValueError:
+            return "sha1:" + hashlib.sha1(body).hexdigest()
+        return urlencode(cls._scrub(pairs))
 
-    def _convert_tracks(self, items):
-        return [SoundCloudTrack(t) for t in items]
+    @classmethod
+    def normalize(cls, method: str, url: str, body=None) -> dict:
+        """Описание запроса без секретов — в таком виде он хранится в кассете"""
+        parts = urlsplit(url)
+        return {
+            "method": method.upper(),
+            "host": parts.hostname,
+            "path": parts.path or "/",
+            "query": urlencode(cls._scrub(parse_qsl(parts.query, keep_blank_values=True))),
+            "body": cls._body_key(body),
+        }
 
-    def search(self, query: str, type_: str = 'track'):
+    @staticmethod
+    def _keys(request: dict):
+        exact = "{method} {host}{path}?{query} {body}".format(**request)
+        # Last.fm ходит на один адрес, различаясь параметром method
+        params = dict(parse_qsl(request["query"])) or dict(parse_qsl(request["body"]))
+        route = f"{request['method']} {request['host']}{request['path']} {params.get('method', '')}"
+        return exact, route
+
+    def _index(self, entry: dict):
+        exact, route = self._keys(entry["request"])
+        self._exact.setdefault(exact, []).append(entry)
+        self._routes.setdefault(route, []).append(entry)
+        self.providers.add(PROVIDER_HOSTS.get(entry["request"]["host"], "?"))
+
+    def load(self):
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    self._index(json.loads(line))
+                except (ValueError, KeyError):
+                    continue  # оборванная запись в конце файла
+        logger.info(f"Кассета {self.path}: {sum(map(len, self._exact.values()))} обменов")
+
+    def record(self, method: str, url: str, body, status: int, headers, content: bytes,
+               elapsed_ms: float):
+        entry = {
+            "request": self.normalize(method, url, body),
+            "status": status,
+            "headers": {k: v for k, v in headers.items() if k.lower() in self.KEPT_HEADERS},
+            "elapsed_ms": round(elapsed_ms, 1),
+        }
         try:
-            if type_ == 'track':
-                res = self.client.get('/tracks', q=query, limit=50)
-                return self._convert_tracks(res)
-            return []
-        except Exception as e:
-            logger.error(f"SoundCloud: ошибка поиска: {e}")
-            return []
+            entry["body"] = content.decode("utf-8")
+        except UnicodeDecodeError:
+            entry["body_b64"] = base64.b64encode(content).decode("ascii")
+        with self._lock:
+            self._index(entry)
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
 
-    def get_playlists(self):
-        return []  # Требует OAuth для приватных плейлистов
+    def find(self, method: str, url: str, body=None) -> Optional[dict]:
+        """Записанный ответ на запрос; повторные запросы получают записи по кругу"""
+        exact, route = self._keys(self.normalize(method, url, body))
+        with self._lock:
+            for key, table in ((exact, self._exact), (route, self._routes)):
+                entries = table.get(key)
+                if entries:
+                    i = self._cursor.get(key, 0)
+                    self._cursor[key] = i + 1
+                    return entries[i % len(entries)]
+        return None
 
-# ======= Реализация Last.fm =======
+    @staticmethod
+    def content(entry: dict) -> bytes:
+        if "body_b64" in entry:
+            return base64.b64decode(entry["body_b64"])
+        return entry.get("body", "").encode("utf-8")
 
-try:
-    import pylast
-except ImportError:
-    pylast = None
 
+class FaultProfile:
+    """Искажения, которые фейковый сервер вносит в ответы.
+    latency_ms=None — задержка как при записи."""
 
-class LastFmTrack:
-    def __init__(self, track_obj):
-        from types import SimpleNamespace
-        self.track_obj = track_obj
-        self.id = track_obj.get_mbid() or track_obj.title
-        self.title = track_obj.title
-        self.duration_ms = (track_obj.get_duration() or 0)
-        self.artists = [SimpleNamespace(name=track_obj.artist.name)]
+    def __init__(self, latency_ms: Optional[float] = None, jitter_ms: float = 0.0,
+                 error_rate: float = 0.0, rate_limit_rate: float = 0.0,
+                 retry_after: float = 1.0, seed: Optional[int] = None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
 
-    def get_download_info(self):
-        return []  # Last.fm не предоставляет аудио
+    def delay(self, recorded_ms: float) -> float:
+        """Задержка ответа в секундах"""
+        base = recorded_ms if self.latency_ms is None else self.latency_ms
+        with self._lock:
+            jitter = self._random.uniform(-self.jitter_ms, self.jitter_ms)
+        return max(base + jitter, 0.0) / 1000
 
+    def fault(self) -> Optional[int]:
+        """HTTP-статус внесённой ошибки (429 или 503) либо None"""
+        with self._lock:
+            roll = self._random.random()
+        if roll < self.rate_limit_rate:
+            return 429
+        if roll < self.rate_limit_rate + self.error_rate:
+            return 503
+        return None
 
-class LastFMMusicAPI(AbstractMusicAPI):
-    """Last.fm API через pylast. audio streaming не поддерживается, используется только метаданные."""
 
-    def __init__(self):
-        self.network = None
+class _FakeProviderHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
 
-    def authenticate(self, api_key: str) -> bool:
-        if pylast is None:
-            logger.error("Не установлена библиотека pylast (pip install pylast)")
-            return False
-        try:
-            self.network = pylast.LastFMNetwork(api_key=api_key)
-            logger.info("Last.fm: клиент инициализирован")
-            return True
-        except Exception as e:
-            logger.error(f"Last.fm: ошибка: {e}")
-            return False
+    def _serve(self):
+        server = self.server.owner
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        # Путь вида /https/api.spotify.com/v1/search?q=...
+        scheme, _, rest = self.path.lstrip("/").partition("/")
+        url = f"{scheme}://{rest}"
+        provider = PROVIDER_HOSTS.get(urlsplit(url).hostname, "?")
+        entry = server.cassette.find(self.command, url, body)
 
-    def search(self, query: str, type_: str = 'track'):
-        try:
-            if type_ == 'track':
-                res = self.network.search_for_track(None, query)
-                tracks = res.get_next_page()
-                return [LastFmTrack(t) for t in tracks]
-            return []
-        except Exception as e:
-            logger.error(f"Last.fm: ошибка поиска: {e}")
-            return []
+        time.sleep(server.profile.delay(entry["elapsed_ms"] if entry else 0.0))
+        status = server.profile.fault()
+        if status == 429:
+            headers = {"Retry-After": f"{server.profile.retry_after:g}"}
+            if provider == "Last.fm":
+                content = (b'<?xml version="1.0" encoding="utf-8"?>\n<lfm status="failed">'
+                           b'<error code="29">Rate Limit Exceeded</error></lfm>')
+                headers["Content-Type"] = "text/xml"
+            else:
+                content = b'{"error": {"status": 429, "message": "API rate limit exceeded"}}'
+                headers["Content-Type"] = "application/json"
+        elif status is not None:
+            headers = {"Content-Type": "application/json"}
+            content = b'{"error": {"status": 503, "message": "Service unavailable"}}'
+        elif entry is None:
+            logger.warning(f"Фейковый сервер: нет записи для {self.command} {url}")
+            status, headers = 404, {"Content-Type": "application/json"}
+            content = b'{"error": {"status": 404, "message": "No recorded exchange"}}'
+        else:
+            status, headers = entry["status"], entry["headers"]
+            content = HttpCassette.content(entry)
+        server.count(provider, status)
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _serve
+
+    def log_message(self, format, *args):
+        logger.debug("Фейковый сервер: " + format % args)
+
+
+class FakeProviderServer:
+    """Локальный HTTP-сервер, отвечающий записями из кассеты с заданными
+    задержкой, разбросом, долей ошибок и 429. Запросы к API провайдеров
+    перенаправляет на него HttpInterceptor в режиме воспроизведения."""
+
+    def __init__(self, cassette: HttpCassette, profile: FaultProfile = None, port: int = 0):
+        self.cassette = cassette
+        self.profile = profile or FaultProfile()
+        self.stats = {}   # провайдер -> {HTTP-статус: число ответов}
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", port), _FakeProviderHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.owner = self
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, provider: str, status: int):
+        with self._lock:
+            by_status = self.stats.setdefault(provider, {})
+            by_status[status] = by_status.get(status, 0) + 1
+
+    def start(self):
+        self._thread.start()
+        logger.info(f"Фейковый сервер провайдеров: {self.url}")
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+class HttpInterceptor:
+    """Перехват HTTP на уровне транспортов requests (yandex-music, spotipy,
+    soundcloud) и httpx (pylast). Запросы к API провайдеров либо записываются
+    в кассету, либо перенаправляются на фейковый сервер; прочие идут как есть."""
+
+    def __init__(self, cassette: HttpCassette, replay_url: Optional[str] = None):
+        self.cassette = cassette
+        self.replay_url = replay_url
+        self._originals = []
+
+    def redirect(self, url: str) -> str:
+        parts = urlsplit(url)
+        return f"{self.replay_url}/{parts.scheme}/{parts.netloc}{parts.path}" + \
+            (f"?{parts.query}" if parts.query else "")
+
+    def install(self):
+        if requests is not None:
+            self._patch(requests.adapters.HTTPAdapter, "send", self._requests_send)
+        if httpx is not None:
+            self._patch(httpx.HTTPTransport, "handle_request", self._httpx_handle)
+        if not self._originals:
+            logger.warning("Перехват HTTP: не найдены ни requests, ни httpx")
+
+    def uninstall(self):
+        for owner, name, original in reversed(self._originals):
+            setattr(owner, name, original)
+        self._originals.clear()
+
+    def _patch(self, owner, name: str, hook):
+        original = getattr(owner, name)
+        self._originals.append((owner, name, original))
+
+        def patched(transport, request, *args, **kwargs):
+            return hook(original, transport, request, *args, **kwargs)
+        setattr(owner, name, patched)
+
+    def _requests_send(self, original, adapter, request, **kwargs):
+        url = request.url
+        if urlsplit(url).hostname not in PROVIDER_HOSTS:
+            return original(adapter, request, **kwargs)
+        if self.replay_url:
+            request.url = self.redirect(url)
+            return original(adapter, request, **kwargs)
+        started = time.monotonic()
+        response = original(adapter, request, **kwargs)
+        self.cassette.record(request.method, url, request.body, response.status_code,
+                             response.headers, response.content,
+                             (time.monotonic() - started) * 1000)
+        return response
+
+    def _httpx_handle(self, original, transport, request):
+        url = str(request.url)
+        if request.url.host not in PROVIDER_HOSTS:
+            return original(transport, request)
+        if self.replay_url:
+            request.url = httpx.URL(self.redirect(url))
+            request.headers["Host"] = request.url.netloc.decode("ascii")
+            return original(transport, request)
+        started = time.monotonic()
+        response = original(transport, request)
+        response.read()
+        self.cassette.record(request.method, url, request.read(),
+                             response.status_code, response.headers, response.content,
+                             (time.monotonic() - started) * 1000)
+        return response
+
+# ======= Отложенные обновления интерфейса =======
+
+class UiUpdateCoalescer(QObject):
+    """Копит изменения интерфейса и применяет их пачкой раз в кадр: из
+    нескольких изменений с одним ключом выполняется только последнее.
+    Пока окно скрыто, изменения не применяются и ждут его показа."""
+
+    FRAME_MS = 16
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._pending = {}   # ключ -> (функция, аргументы)
+        self._active = True
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(self.FRAME_MS)
+        self.timer.timeout.connect(self.flush)
+
+    def post(self, key: str, func, *args):
+        self._pending[key] = (func, args)
+        if self._active and not self.timer.isActive():
+            self.timer.start()
+
+    def set_active(self, active: bool):
+        """Окно показано или скрыто (в трее, свёрнуто)"""
+        if active == self._active:
+            return
+        self._active = active
+        if not active:
+            self.timer.stop()
+        elif self._pending:
+            self.timer.start()
+
+    def flush(self):
+        pending, self._pending = self._pending, {}
+        for func, args in pending.values():
+            func(*args)
+
+
+@contextmanager
+def batched_updates(widget: QWidget):
+    """Перерисовать виджет один раз после пачки изменений"""
+    if not widget.updatesEnabled():
+        yield  # уже внутри пачки
+        return
+    widget.setUpdatesEnabled(False)
+    try:
+        yield
+    finally:
+        widget.setUpdatesEnabled(True)
 
 class PlaylistWidget(QListWidget):
     """Виджет для отображения плейлистов"""
@@ -366,6 +3720,7 @@ class PlaylistWidget(QListWidget):
         super().__init__(parent)
         self.api = None
         self.playlists = []
+        self.smart_names = []
         
     def set_api(self, api: Any):
         self.api = api
@@ -375,8 +3730,18 @@ class PlaylistWidget(QListWidget):
         if not self.api:
             return
             
-        self.clear()
         self.playlists = self.api.get_playlists()
+        with batched_updates(self):
+            self._fill()
+    
+    def set_smart_playlists(self, names: List[str]):
+        """Показать умные плейлисты (без обращения к сервису)"""
+        self.smart_names = names
+        with batched_updates(self):
+            self._fill()
+    
+    def _fill(self):
+        self.clear()
         
         # Добавить специальные плейлисты
         special_items = [
@@ -389,6 +3754,12 @@ class PlaylistWidget(QListWidget):
             list_item.setData(Qt.UserRole, item)
             self.addItem(list_item)
         
+        # Умные плейлисты по локальной библиотеке
+        for name in self.smart_names:
+            list_item = QListWidgetItem(f"✨ {name}")
+            list_item.setData(Qt.UserRole, {"name": name, "type": "smart"})
+            self.addItem(list_item)
+        
         # Добавить пользовательские плейлисты
         for playlist in self.playlists:
             item_text = f"📁 {playlist.title} ({playlist.track_count} треков)"
@@ -415,27 +3786,68 @@ class TrackListWidget(QListWidget):
     def __init__(self, parent=None):
         super().__init__(parent)
         self.tracks = []
+        self.setUniformItemSizes(True)  # все строки одной высоты — без пересчёта раскладки
         
     def load_tracks(self, tracks: List[Track]):
         """Загрузить треки"""
-        self.clear()
-        self.tracks = tracks
+        with batched_updates(self):
+            self.clear()
+            self.tracks = tracks
+            
+            for track in tracks:
+                self.addItem(self._make_item(track))
+    
+    def append_tracks(self, tracks: List[Track]):
+        """Дописать треки в конец списка, не перерисовывая уже показанные"""
+        self.tracks = list(self.tracks) + list(tracks)
+        with batched_updates(self):
+            for track in tracks:
+                self.addItem(self._make_item(track))
+    
+    def replace_track(self, row: int, track):
+        """Заменить трек в строке row (например, найдена воспроизводимая версия)"""
+        self.tracks[row] = track
+        self.takeItem(row)
+        self.insertItem(row, self._make_item(track))
+    
+    def apply_changes(self, tracks):
+        """Привести список к tracks, трогая только удалённые и добавленные строки"""
+        with batched_updates(self):
+            self._apply_changes(tracks)
+    
+    def _apply_changes(self, tracks):
+        new_ids = [str(t.id) for t in tracks]
+        keep = set(new_ids)
+        for row in reversed(range(len(self.tracks))):
+            if str(self.tracks[row].id) not in keep:
+                self.takeItem(row)
+                del self.tracks[row]
         
-        for track in tracks:
-            if hasattr(track, 'track'):
-                track = track.track  # Для TrackShort объектов
-                
-            artist_names = ", ".join([artist.name for artist in track.artists])
-            item_text = f"🎵 {track.title} - {artist_names}"
+        current = [str(t.id) for t in self.tracks]
+        present = set(current)
+        if current != [i for i in new_ids if i in present]:
+            self.load_tracks(list(tracks))  # порядок изменился — проще перерисовать
+            return
+        for row, track in enumerate(tracks):
+            if row >= len(self.tracks) or str(self.tracks[row].id) != new_ids[row]:
+                self.tracks.insert(row, track)
+                self.insertItem(row, self._make_item(track))
+    
+    def _make_item(self, track) -> QListWidgetItem:
+        if hasattr(track, 'track'):
+            track = track.track  # Для TrackShort объектов
             
-            list_item = QListWidgetItem(item_text)
-            list_item.setData(Qt.UserRole, {
-                "track": track,
-                "title": track.title,
-                "artist": artist_names,
-                "duration": track.duration_ms // 1000 if track.duration_ms else 0
-            })
-            self.addItem(list_item)
+        artist_names = ", ".join([artist.name for artist in track.artists])
+        item_text = f"🎵 {track.title} - {artist_names}"
+        
+        list_item = QListWidgetItem(item_text)
+        list_item.setData(Qt.UserRole, {
+            "track": track,
+            "title": track.title,
+            "artist": artist_names,
+            "duration": track.duration_ms // 1000 if track.duration_ms else 0
+        })
+        return list_item
     
     def mousePressEvent(self, event):
         super().mousePressEvent(event)
@@ -455,6 +3867,7 @@ class PlayerControls(QWidget):
     
     def __init__(self, parent=None):
         super().__init__(parent)
+        self.shown_position = None  # (позиция, длительность) в секундах на экране
         self.init_ui()
         
     def init_ui(self):
@@ -497,8 +3910,17 @@ class PlayerControls(QWidget):
         self.play_pause_btn.setText("⏸" if playing else "▶")
     
     def set_position(self, position: int, duration: int):
-        self.position_slider.setMaximum(duration)
-        self.position_slider.setValue(position)
+        if (position, duration) == self.shown_position:
+            return
+        self.shown_position = (position, duration)
+        
+        # Не мешать перетаскиванию; программное изменение — не перемотка
+        if not self.position_slider.isSliderDown():
+            self.position_slider.blockSignals(True)
+            if self.position_slider.maximum() != duration:
+                self.position_slider.setMaximum(duration)
+            self.position_slider.setValue(position)
+            self.position_slider.blockSignals(False)
         
         pos_min, pos_sec = divmod(position, 60)
         dur_min, dur_sec = divmod(duration, 60)
@@ -574,30 +3996,141 @@ class AuthDialog(QDialog):
     def get_token(self):
         return self.token_input.text().strip()
 
+class SmartPlaylistDialog(QDialog):
+    """Создание и изменение умного плейлиста"""
+    
+    SORTS = [
+        ("Как в библиотеке", ""),
+        ("Давно не слушал", "least_recent"),
+        ("Недавно слушал", "recent"),
+        ("Чаще всего", "plays"),
+        ("По длительности", "duration"),
+        ("Случайно", "random"),
+    ]
+    
+    def __init__(self, collections: Dict[str, str], name: str = "", rules: dict = None, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Умный плейлист")
+        self.setModal(True)
+        self.init_ui(collections, name, rules or {})
+        
+    def init_ui(self, collections: Dict[str, str], name: str, rules: dict):
+        layout = QFormLayout()
+        
+        self.name_input = QLineEdit(name)
+        layout.addRow("Название:", self.name_input)
+        
+        # Откуда брать треки
+        self.collection_combo = QComboBox()
+        self.collection_combo.addItem("Вся библиотека", "")
+        for key, title in collections.items():
+            self.collection_combo.addItem(title, key)
+        self.collection_combo.setCurrentIndex(max(0, self.collection_combo.findData(rules.get("collection", ""))))
+        layout.addRow("Коллекция:", self.collection_combo)
+        
+        # 0 — без ограничения
+        self.max_duration = QDoubleSpinBox()
+        self.max_duration.setRange(0, 60)
+        self.max_duration.setSingleStep(0.5)
+        self.max_duration.setSpecialValueText("без ограничения")
+        self.max_duration.setValue(rules.get("max_duration_sec", 0) / 60)
+        layout.addRow("Короче, мин:", self.max_duration)
+        
+        self.artists_input = QLineEdit(", ".join(rules.get("artists", [])))
+        self.artists_input.setPlaceholderText("через запятую")
+        layout.addRow("Исполнители:", self.artists_input)
+        
+        self.exclude_input = QLineEdit(", ".join(rules.get("exclude_artists", [])))
+        self.exclude_input.setPlaceholderText("через запятую")
+        layout.addRow("Кроме исполнителей:", self.exclude_input)
+        
+        self.not_played = QSpinBox()
+        self.not_played.setRange(0, 3650)
+        self.not_played.setSpecialValueText("неважно")
+        self.not_played.setValue(rules.get("not_played_days", 0))
+        layout.addRow("Не слушал дней:", self.not_played)
+        
+        self.sort_combo = QComboBox()
+        for title, key in self.SORTS:
+            self.sort_combo.addItem(title, key)
+        self.sort_combo.setCurrentIndex(max(0, self.sort_combo.findData(rules.get("sort", ""))))
+        layout.addRow("Порядок:", self.sort_combo)
+        
+        self.limit = QSpinBox()
+        self.limit.setRange(0, 100000)
+        self.limit.setSpecialValueText("все")
+        self.limit.setValue(rules.get("limit", 0))
+        layout.addRow("Не больше треков:", self.limit)
+        
+        # Кнопки
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        layout.addRow(buttons)
+        
+        self.setLayout(layout)
+    
+    def get_name(self) -> str:
+        return self.name_input.text().strip()
+    
+    def get_rules(self) -> dict:
+        """Правила для LibraryIndex.query (только заданные условия)"""
+        rules = {
+            "collection": self.collection_combo.currentData(),
+            "max_duration_sec": round(self.max_duration.value() * 60),
+            "artists": self._split(self.artists_input.text()),
+            "exclude_artists": self._split(self.exclude_input.text()),
+            "not_played_days": self.not_played.value(),
+            "sort": self.sort_combo.currentData(),
+            "limit": self.limit.value(),
+        }
+        return {key: value for key, value in rules.items() if value}
+    
+    @staticmethod
+    def _split(text: str) -> List[str]:
+        return [name.strip() for name in text.split(",") if name.strip()]
+
 class MainWindow(QMainWindow):
     """Главное окно приложения"""
     
-    def __init__(self):
+    track_resolved = pyqtSignal(int, object, object)  # строка, исходный трек, найденный
+    
+    def __init__(self, daemon_socket: Optional[str] = None):
         super().__init__()
 
         # --- Провайдеры ---
         self.settings = QSettings("YandexMusicPlayer", "Settings")
         self.current_provider = self.settings.value("provider", "Yandex")
-
-        # Словарь доступных провайдеров
-        self.PROVIDERS = {
-            "Yandex": YandexMusicAPI,
-            "Spotify": SpotifyMusicAPI,
-            "Last.fm": LastFMMusicAPI,
-            "SoundCloud": SoundCloudMusicAPI,
-        }
+        self.providers = ProviderRegistry(self.settings)
 
         self.api = None  # будет установлен в set_provider
+        self.search_failures = []
 
-        self.player = QMediaPlayer()
-        self.current_playlist = []
-        self.current_index = 0
+        self.federated_search = FederatedSearch(self)
+        self.federated_search.results_ready.connect(self.on_federated_results)
+        self.federated_search.provider_failed.connect(self.on_federated_failed)
+        self.federated_search.provider_authenticated.connect(self.on_provider_authenticated)
+        self.federated_search.finished.connect(self.on_federated_finished)
+
+        # Сопоставление треков Last.fm с воспроизводимыми
+        self.track_resolved.connect(self.on_track_resolved)
+
+        # Дельта-синхронизация понравившихся и плейлистов
+        self.current_collection = None  # ключ коллекции, показанной в списке треков
+        self.library_sync = LibrarySync(self.providers, parent=self)
+        self.library_sync.collection_updated.connect(self.on_collection_updated)
+
+        # Воспроизведение: своё ядро или тонкий клиент запущенного демона
+        if daemon_socket:
+            self.core = DaemonClient(daemon_socket, self)
+        else:
+            self.core = PlayerCore(self.providers, self.settings, self)
         self.is_playing = False
+        self.ui_updates = UiUpdateCoalescer(self)
+        
+        # Умные плейлисты: история ведётся ядром (своим или демона)
+        history = self.core.history if isinstance(self.core, PlayerCore) else PlayHistory()
+        self.smart_playlists = SmartPlaylists(self.library_sync, history, self.settings, self)
         
         # Системный трей
         self.tray_icon = SystemTrayIcon(self)
@@ -627,7 +4160,7 @@ class MainWindow(QMainWindow):
         # Выбор источника
         left_panel.addWidget(QLabel("Источник"))
         self.provider_combo = QComboBox()
-        self.provider_combo.addItems(self.PROVIDERS.keys())
+        self.provider_combo.addItems(ProviderRegistry.PROVIDERS.keys())
         self.provider_combo.setCurrentText(self.current_provider)
         self.provider_combo.currentTextChanged.connect(self.on_provider_changed)
         left_panel.addWidget(self.provider_combo)
@@ -658,8 +4191,11 @@ class MainWindow(QMainWindow):
         self.search_btn = QPushButton("🔍")
         self.search_btn.clicked.connect(self.search_tracks)
         self.search_input.returnPressed.connect(self.search_tracks)
+        self.all_sources_check = QCheckBox("Все источники")
+        self.all_sources_check.setChecked(self.settings.value("search/all_sources", False, type=bool))
         
         search_layout.addWidget(self.search_input)
+        search_layout.addWidget(self.all_sources_check)
         search_layout.addWidget(self.search_btn)
         right_panel.addLayout(search_layout)
         
@@ -688,6 +4224,9 @@ class MainWindow(QMainWindow):
         # Показать иконку в трее
         self.tray_icon.show()
 
+        # Восстановить очередь до подключения к провайдеру
+        self.restore_session()
+
         # Установить провайдера после создания всех виджетов
         self.set_provider(self.current_provider)
     
@@ -707,6 +4246,30 @@ class MainWindow(QMainWindow):
         exit_action.triggered.connect(QApplication.quit)
         file_menu.addAction(exit_action)
         
+        # Воспроизведение
+        playback_menu = menubar.addMenu('Воспроизведение')
+        
+        crossfade_action = QAction('Кроссфейд между треками', self)
+        crossfade_action.setCheckable(True)
+        crossfade_action.setChecked(self.settings.value("crossfade/enabled", False, type=bool))
+        crossfade_action.toggled.connect(self.toggle_crossfade)
+        playback_menu.addAction(crossfade_action)
+        
+        # Библиотека
+        library_menu = menubar.addMenu('Библиотека')
+        
+        new_smart_action = QAction('Новый умный плейлист…', self)
+        new_smart_action.triggered.connect(lambda: self.edit_smart_playlist(None))
+        library_menu.addAction(new_smart_action)
+        
+        edit_smart_action = QAction('Изменить умный плейлист…', self)
+        edit_smart_action.triggered.connect(self.edit_selected_smart_playlist)
+        library_menu.addAction(edit_smart_action)
+        
+        remove_smart_action = QAction('Удалить умный плейлист', self)
+        remove_smart_action.triggered.connect(self.remove_smart_playlist)
+        library_menu.addAction(remove_smart_action)
+        
         # Справка
         help_menu = menubar.addMenu('Справка')
         
@@ -717,25 +4280,29 @@ class MainWindow(QMainWindow):
     def connect_signals(self):
         # Плейлисты
         self.playlist_widget.playlist_selected.connect(self.on_playlist_selected)
+        self.smart_playlists.changed.connect(
+            lambda: self.playlist_widget.set_smart_playlists(self.smart_playlists.names()))
+        self.smart_playlists.collection_updated.connect(self.on_collection_updated)
+        self.playlist_widget.set_smart_playlists(self.smart_playlists.names())
         
         # Треки
         self.track_list.track_selected.connect(self.play_track)
         
         # Плеер
-        self.player_controls.play_pause_clicked.connect(self.toggle_playback)
-        self.player_controls.prev_clicked.connect(self.prev_track)
-        self.player_controls.next_clicked.connect(self.next_track)
-        self.player_controls.volume_changed.connect(self.player.setVolume)
+        self.player_controls.play_pause_clicked.connect(self.core.toggle_playback)
+        self.player_controls.prev_clicked.connect(self.core.prev_track)
+        self.player_controls.next_clicked.connect(self.core.next_track)
+        self.player_controls.volume_changed.connect(self.core.setVolume)
         
         # События плеера
-        self.player.stateChanged.connect(self.on_state_changed)
-        self.player.positionChanged.connect(self.on_position_changed)
-        self.player.durationChanged.connect(self.on_duration_changed)
+        self.core.state_changed.connect(self.on_state_changed)
+        self.core.position_changed.connect(self.on_position_changed)
+        self.core.track_started.connect(self.on_track_started)
+        self.core.error.connect(lambda message: QMessageBox.warning(self, "Ошибка", message))
     
     def check_auth(self) -> bool:
         """Проверить авторизацию"""
-        token_key = f"{self.current_provider.lower()}_token"
-        token = self.settings.value(token_key, "")
+        token = self.providers.token(self.current_provider)
         if token:
             return self.api.authenticate(token)
         return False
@@ -746,19 +4313,40 @@ class MainWindow(QMainWindow):
         if dialog.exec_() == QDialog.Accepted:
             token = dialog.get_token()
             if token and self.api.authenticate(token):
-                token_key = f"{self.current_provider.lower()}_token"
-                self.settings.setValue(token_key, token)
+                self.providers.set_token(self.current_provider, token)
+                self.providers.register(self.current_provider, self.api)
                 self.statusBar().showMessage("Авторизация успешна")
                 self.playlist_widget.load_playlists()
             else:
                 QMessageBox.warning(self, "Ошибка", "Неверный токен авторизации")
     
+    def show_tracks(self, tracks, collection: Optional[str] = None):
+        """Показать треки в списке и сделать их очередью воспроизведения"""
+        # Незавершённый поиск по всем источникам дописывал бы чужой список
+        self.federated_search.cancel()
+        self.current_collection = collection
+        self.track_list.load_tracks(tracks)
+        self.core.set_queue(self.track_list.tracks)
+    
+    def on_collection_updated(self, key: str, tracks: list):
+        """Синхронизация изменила коллекцию — обновить открытый список на месте"""
+        if key != self.current_collection or self.core.queue is not self.track_list.tracks:
+            return
+        queue = self.core.queue
+        playing = str(queue[self.core.current_index].id) if self.core.current_index < len(queue) else None
+        self.track_list.apply_changes(tracks)
+        for i, track in enumerate(self.track_list.tracks):
+            if str(track.id) == playing:
+                self.core.current_index = i
+                break
+        self.core.set_queue(self.track_list.tracks)
+        self.statusBar().showMessage(f"Синхронизировано: {len(tracks)} треков")
+    
     def load_my_wave(self):
         """Загрузить Мою Волну"""
         try:
             tracks = self.api.get_my_wave()
-            self.track_list.load_tracks(tracks)
-            self.current_playlist = tracks
+            self.show_tracks(tracks)
             self.statusBar().showMessage(f"Загружена Моя Волна: {len(tracks)} треков")
         except Exception as e:
             QMessageBox.warning(self, "Ошибка", f"Не удалось загрузить Мою Волну: {e}")
@@ -769,101 +4357,204 @@ class MainWindow(QMainWindow):
         
         if playlist_type == "wave":
             self.load_my_wave()
+        elif playlist_type == "smart":
+            self.load_smart_playlist(data["name"])
         elif playlist_type == "liked":
             try:
-                tracks = self.api.get_liked_tracks()
-                self.track_list.load_tracks(tracks)
-                self.current_playlist = tracks
+                # Локальная копия показывается сразу, изменения подтянет синхронизация.
+                # Синхронизируется только библиотека сервиса с ревизиями (Яндекс)
+                syncable = self.api.supports_revisions
+                if syncable and self.library_sync.revision("liked") is not None:
+                    tracks = self.library_sync.tracks("liked")
+                else:
+                    tracks = self.api.get_liked_tracks()
+                    revision = getattr(tracks, 'revision', None)
+                    if syncable and revision is not None:
+                        self.library_sync.remember("liked", revision, tracks)
+                self.show_tracks(tracks, "liked" if syncable else None)
+                if syncable:
+                    self.library_sync.start()
                 self.statusBar().showMessage(f"Загружены понравившиеся: {len(tracks)} треков")
             except Exception as e:
                 QMessageBox.warning(self, "Ошибка", f"Не удалось загрузить понравившиеся: {e}")
         elif playlist_type == "playlist":
             try:
                 playlist = data["playlist"]
-                tracks = playlist.fetch_tracks()
-                self.track_list.load_tracks(tracks)
-                self.current_playlist = tracks
+                key = f"playlist:{getattr(playlist, 'kind', '')}"
+                revision = getattr(playlist, 'revision', None)
+                if self.api.supports_revisions and revision is not None \
+                        and self.library_sync.revision(key) == revision:
+                    tracks = self.library_sync.tracks(key)
+                else:
+                    tracks = playlist.fetch_tracks()
+                    if self.api.supports_revisions and revision is not None:
+                        self.library_sync.remember(key, revision, tracks)
+                self.show_tracks(tracks, key)
                 self.statusBar().showMessage(f"Загружен плейлист: {playlist.title}")
             except Exception as e:
                 QMessageBox.warning(self, "Ошибка", f"Не удалось загрузить плейлист: {e}")
     
+    def load_smart_playlist(self, name: str):
+        """Показать умный плейлист, вычисленный по локальной библиотеке"""
+        if np is None:
+            QMessageBox.warning(self, "Умные плейлисты", "Для умных плейлистов установите numpy: pip install numpy")
+            return
+        tracks = self.smart_playlists.tracks(name)
+        self.show_tracks(tracks, f"smart:{name}")
+        self.library_sync.start()
+        self.statusBar().showMessage(f"Умный плейлист «{name}»: {len(tracks)} треков")
+    
+    def selected_smart_playlist(self) -> Optional[str]:
+        item = self.playlist_widget.currentItem()
+        data = item.data(Qt.UserRole) if item else None
+        return data["name"] if data and data.get("type") == "smart" else None
+    
+    def edit_smart_playlist(self, name: Optional[str]):
+        """Создать умный плейлист (name=None) или изменить существующий"""
+        collections = {"liked": "Мне нравится"}
+        for playlist in self.playlist_widget.playlists:
+            key = f"playlist:{getattr(playlist, 'kind', '')}"
+            if self.library_sync.revision(key) is not None:
+                collections[key] = playlist.title
+        dialog = SmartPlaylistDialog(collections, name or "", self.smart_playlists.rules(name), self)
+        if dialog.exec_() != QDialog.Accepted or not dialog.get_name():
+            return
+        if name and dialog.get_name() != name:
+            self.smart_playlists.remove(name)
+        self.smart_playlists.save(dialog.get_name(), dialog.get_rules())
+        self.load_smart_playlist(dialog.get_name())
+    
+    def edit_selected_smart_playlist(self):
+        name = self.selected_smart_playlist()
+        if name is None:
+            self.statusBar().showMessage("Выберите умный плейлист в списке")
+            return
+        self.edit_smart_playlist(name)
+    
+    def remove_smart_playlist(self):
+        name = self.selected_smart_playlist()
+        if name is None:
+            self.statusBar().showMessage("Выберите умный плейлист в списке")
+            return
+        if QMessageBox.question(self, "Умные плейлисты", f"Удалить «{name}»?") == QMessageBox.Yes:
+            self.smart_playlists.remove(name)
+    
     def search_tracks(self):
         """Поиск треков"""
         query = self.search_input.text().strip()
         if not query:
             return
+        
+        if self.all_sources_check.isChecked():
+            self.search_all_sources(query)
+            return
+        self.federated_search.cancel()
             
         try:
             tracks = self.api.search(query, 'track')
-            self.track_list.load_tracks(tracks)
-            self.current_playlist = tracks
+            self.show_tracks(tracks)
             self.statusBar().showMessage(f"Найдено треков: {len(tracks)}")
+            self.resolve_unplayable()
         except Exception as e:
             QMessageBox.warning(self, "Ошибка", f"Ошибка поиска: {e}")
     
-    def play_track(self, track_data: dict):
-        """Воспроизвести трек"""
-        try:
-            track = track_data["track"]
-            
-            # Найти индекс в текущем плейлисте
-            for i, pl_track in enumerate(self.current_playlist):
-                if hasattr(pl_track, 'track'):
-                    pl_track = pl_track.track
-                if pl_track.id == track.id:
-                    self.current_index = i
-                    break
-            
-            # Получить URL для воспроизведения
-            download_info = track.get_download_info()
-            if download_info:
-                url = download_info[0].get_direct_link()
-                self.player.setMedia(QMediaContent(QUrl(url)))
-                self.player.play()
-                self.statusBar().showMessage(f"Воспроизводится: {track.title}")
-            else:
-                QMessageBox.warning(self, "Ошибка", "Не удалось получить ссылку на трек")
-                
-        except Exception as e:
-            QMessageBox.warning(self, "Ошибка", f"Ошибка воспроизведения: {e}")
+    def search_all_sources(self, query: str):
+        """Поиск сразу по всем провайдерам, у которых есть токен"""
+        # Токены и экземпляры готовятся здесь: потоки поиска не трогают QSettings и реестр
+        providers = {}
+        for name in ProviderRegistry.PROVIDERS:
+            if name in self.providers.apis:
+                providers[name] = (self.providers.apis[name], "")
+            elif self.providers.token(name):
+                providers[name] = (self.providers.create(name), self.providers.token(name))
+        if not providers:
+            self.statusBar().showMessage("Нет авторизованных источников")
+            return
+        self.show_tracks([])
+        self.search_failures = []
+        self.federated_search.start(query, providers)
+        self.statusBar().showMessage(f"Поиск в источниках: {', '.join(providers)}...")
     
-    def toggle_playback(self):
-        """Переключить воспроизведение/паузу"""
-        if self.player.state() == QMediaPlayer.PlayingState:
-            self.player.pause()
-        else:
-            self.player.play()
+    def on_federated_results(self, provider_name: str, added: list, replaced: list):
+        """Очередной провайдер ответил — дописать его результаты"""
+        for row, track in replaced:
+            self.track_list.replace_track(row, track)
+        self.track_list.append_tracks(added)
+        self.core.set_queue(self.track_list.tracks)
+        self.statusBar().showMessage(f"Найдено треков: {len(self.track_list.tracks)} (ответил {provider_name})")
     
-    def prev_track(self):
-        """Предыдущий трек"""
-        if self.current_playlist and self.current_index > 0:
-            self.current_index -= 1
-            track = self.current_playlist[self.current_index]
-            if hasattr(track, 'track'):
-                track = track.track
-            self.play_track({"track": track})
+    def on_provider_authenticated(self, provider_name: str, api):
+        if provider_name not in self.providers.apis:
+            self.providers.register(provider_name, api)
     
-    def next_track(self):
-        """Следующий трек"""
-        if self.current_playlist and self.current_index < len(self.current_playlist) - 1:
-            self.current_index += 1
-            track = self.current_playlist[self.current_index]
-            if hasattr(track, 'track'):
-                track = track.track
-            self.play_track({"track": track})
+    def on_federated_failed(self, provider_name: str, reason: str):
+        self.search_failures.append(f"{provider_name}: {reason}")
+    
+    def on_federated_finished(self):
+        message = f"Найдено треков: {len(self.track_list.tracks)}"
+        if self.search_failures:
+            message += f" (без ответа — {'; '.join(self.search_failures)})"
+        self.statusBar().showMessage(message)
+        self.resolve_unplayable()
+    
+    def resolve_unplayable(self):
+        """В фоне подобрать воспроизводимые версии для треков Last.fm в списке"""
+        rows = [i for i, t in enumerate(self.track_list.tracks) if isinstance(t, LastFmTrack)]
+        if not rows:
+            return
+        originals = [self.track_list.tracks[i] for i in rows]
+        
+        def run():
+            try:
+                with RequestScheduler.priority(Priority.PREFETCH):
+                    self.providers.resolver.resolve(
+                        originals,
+                        on_resolved=lambda k, found: self.track_resolved.emit(rows[k], originals[k], found))
+            except Exception as e:
+                logger.error(f"Ошибка сопоставления треков: {e}")
+        
+        threading.Thread(target=run, name="resolver", daemon=True).start()
+    
+    def on_track_resolved(self, row: int, original, track):
+        """Найдена воспроизводимая версия — подменить строку, если список не менялся"""
+        if row < len(self.track_list.tracks) and self.track_list.tracks[row] is original:
+            self.track_list.replace_track(row, track)
+            self.core.set_queue(self.track_list.tracks)
+    
+    def play_track(self, track_data: dict):
+        """Воспроизвести трек"""
+        self.core.play_track(track_data["track"])
+    
+    def on_track_started(self, index: int, track):
+        self.statusBar().showMessage(f"Воспроизводится: {track.title}")
     
     def on_state_changed(self, state):
         """Обработка изменения состояния плеера"""
         self.is_playing = (state == QMediaPlayer.PlayingState)
-        self.player_controls.set_playing(self.is_playing)
+        self.ui_updates.post("playing", self.player_controls.set_playing, self.is_playing)
     
-    def on_position_changed(self, position):
+    def on_position_changed(self, position, duration):
         """Обработка изменения позиции"""
-        self.player_controls.set_position(position // 1000, self.player.duration() // 1000)
+        self.ui_updates.post("position", self.player_controls.set_position,
+                             position // 1000, duration // 1000)
     
-    def on_duration_changed(self, duration):
-        """Обработка изменения длительности"""
-        pass
+    def restore_session(self):
+        """Показать очередь и позицию из снимка прошлой сессии (или состояние демона)"""
+        try:
+            visible = self.core.restore()
+        except Exception as e:
+            logger.error(f"Не удалось восстановить сессию: {e}")
+            return
+        self.track_list.load_tracks(visible)
+        if not self.core.queue:
+            return
+        
+        if self.core.queue is self.track_list.tracks:
+            self.track_list.setCurrentRow(self.core.current_index)
+        self.player_controls.set_position(self.core.resume_position_ms // 1000,
+                                          self.core.current_duration_ms // 1000)
+        track = self.core.queue[self.core.current_index]
+        self.statusBar().showMessage(f"Восстановлена сессия: {track.title}")
     
     def load_settings(self):
         """Загрузить настройки"""
@@ -871,15 +4562,22 @@ class MainWindow(QMainWindow):
         if geometry:
             self.restoreGeometry(geometry)
         
-        volume = self.settings.value("volume", 50)
-        self.player.setVolume(int(volume))
-        self.player_controls.volume_slider.setValue(int(volume))
+        self.player_controls.volume_slider.setValue(self.core.volume())
     
     def save_settings(self):
         """Сохранить настройки"""
         self.settings.setValue("geometry", self.saveGeometry())
-        self.settings.setValue("volume", self.player.volume())
+        self.settings.setValue("volume", self.core.volume())
         self.settings.setValue("provider", self.current_provider)
+        self.settings.setValue("search/all_sources", self.all_sources_check.isChecked())
+    
+    def toggle_crossfade(self, enabled: bool):
+        """Включить/выключить движок кроссфейда"""
+        self.settings.setValue("crossfade/enabled", enabled)
+        if enabled and np is None:
+            QMessageBox.warning(self, "Кроссфейд", "Для кроссфейда установите numpy: pip install numpy")
+            return
+        self.statusBar().showMessage("Изменение вступит в силу после перезапуска")
     
     def show_about(self):
         """О программе"""
@@ -889,6 +4587,19 @@ class MainWindow(QMainWindow):
                          "для Arch Linux\n\n"
                          "Использует yandex-music API")
     
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.ui_updates.set_active(not self.isMinimized())
+    
+    def hideEvent(self, event):
+        super().hideEvent(event)
+        self.ui_updates.set_active(False)  # в трее интерфейс не обновляется
+    
+    def changeEvent(self, event):
+        super().changeEvent(event)
+        if event.type() == QEvent.WindowStateChange:
+            self.ui_updates.set_active(self.isVisible() and not self.isMinimized())
+    
     def closeEvent(self, event):
         """Обработка закрытия окна"""
         # Сохранить настройки
@@ -908,25 +4619,150 @@ class MainWindow(QMainWindow):
 
     def set_provider(self, provider_name: str):
         """Сменить музыкальный сервис"""
-        if provider_name not in self.PROVIDERS:
+        if provider_name not in ProviderRegistry.PROVIDERS:
             QMessageBox.warning(self, "Ошибка", f"Неизвестный провайдер: {provider_name}")
             return
 
         self.current_provider = provider_name
-        self.api = self.PROVIDERS[provider_name]()
+        self.api = self.providers.create(provider_name)
         self.playlist_widget.set_api(self.api)
 
         # попытаться автоматически авторизоваться
         if not self.check_auth():
             self.statusBar().showMessage("Требуется авторизация для " + provider_name)
         else:
+            self.providers.register(provider_name, self.api)
             self.playlist_widget.load_playlists()
+            self.library_sync.start()
 
     def on_provider_changed(self, text):
         """Обработчик изменения выбранного сервиса"""
         self.set_provider(text)
 
+def run_daemon(socket_path: str) -> int:
+    """Фоновый режим: без окна и трея, управление через JSON-RPC сокет"""
+    app = QCoreApplication(sys.argv)
+    settings = QSettings("YandexMusicPlayer", "Settings")
+    providers = ProviderRegistry(settings)
+    core = PlayerCore(providers, settings)
+    core.restore()
+    try:
+        server = RpcServer(core, providers, socket_path)
+    except OSError as e:
+        logger.error(str(e))
+        return 1
+
+    # SIGINT/SIGTERM будят цикл событий через pipe — без таймеров-опросов
+    read_fd, write_fd = os.pipe()
+    os.set_blocking(write_fd, False)
+    signal.set_wakeup_fd(write_fd)
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *args: None)
+    notifier = QSocketNotifier(read_fd, QSocketNotifier.Read)
+    notifier.activated.connect(lambda: (os.read(read_fd, 64), app.quit()))
+
+    code = app.exec_()
+    QLocalServer.removeServer(socket_path)
+    return code
+
+def run_load_test(providers: ProviderRegistry, names: List[str], queries: List[str],
+                  total: int, concurrency: int) -> dict:
+    """Выполнить total поисковых запросов к каждому провайдеру через планировщик
+    и вернуть пропускную способность и перцентили задержки"""
+    report = {}
+    for name in names:
+        api = providers.get(name)
+        if api is None:
+            logger.warning(f"Нагрузочный тест: провайдер {name} недоступен")
+            continue
+
+        def one(i: int):
+            started = time.monotonic()
+            found = api.search(queries[i % len(queries)])
+            return time.monotonic() - started, bool(found)
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(one, range(total)))
+        wall = time.monotonic() - started
+        latencies = sorted(latency for latency, _ in results)
+        report[name] = {
+            "requests": total,
+            "empty": sum(1 for _, found in results if not found),
+            "rps": round(total / wall, 2) if wall else None,
+            **{f"p{p}_ms": round(latencies[min(len(latencies) - 1, len(latencies) * p // 100)] * 1000, 1)
+               for p in (50, 95, 99)},
+            "max_ms": round(latencies[-1] * 1000, 1),
+        }
+    return report
+
 def main():
+    parser = argparse.ArgumentParser(description="Yandex Music Player")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--daemon", action="store_true",
+                      help="фоновый режим без интерфейса, управление через JSON-RPC сокет")
+    mode.add_argument("--attach", action="store_true",
+                      help="запустить интерфейс как клиент уже работающего демона")
+    parser.add_argument("--socket", default=str(DAEMON_SOCKET), help="путь к Unix-сокету демона")
+
+    fixtures = parser.add_argument_group("запись и воспроизведение трафика провайдеров")
+    cassette_mode = fixtures.add_mutually_exclusive_group()
+    cassette_mode.add_argument("--record", metavar="FILE",
+                               help="записывать обмены с API провайдеров в кассету")
+    cassette_mode.add_argument("--replay", metavar="FILE",
+                               help="отвечать на запросы к API из кассеты через локальный сервер")
+    fixtures.add_argument("--fake-latency", type=float, metavar="MS",
+                          help="задержка ответа (по умолчанию — как при записи)")
+    fixtures.add_argument("--fake-jitter", type=float, default=0.0, metavar="MS",
+                          help="разброс задержки, ±MS")
+    fixtures.add_argument("--fake-error-rate", type=float, default=0.0, metavar="P",
+                          help="доля ответов 503")
+    fixtures.add_argument("--fake-429-rate", type=float, default=0.0, metavar="P",
+                          help="доля ответов 429")
+    fixtures.add_argument("--fake-retry-after", type=float, default=1.0, metavar="SEC",
+                          help="Retry-After во внесённых ответах 429")
+    fixtures.add_argument("--fake-seed", type=int, help="зерно генератора искажений")
+    fixtures.add_argument("--load-test", type=int, metavar="N",
+                          help="выполнить N поисковых запросов к каждому провайдеру и вывести отчёт")
+    fixtures.add_argument("--load-query", action="append", metavar="QUERY",
+                          help="поисковый запрос нагрузочного теста (можно повторять)")
+    fixtures.add_argument("--load-concurrency", type=int, default=8, metavar="N",
+                          help="число параллельных запросов нагрузочного теста")
+    args = parser.parse_args()
+
+    fake_server = None
+    if args.record or args.replay:
+        cassette = HttpCassette(Path(args.record or args.replay))
+        if args.replay:
+            fake_server = FakeProviderServer(cassette, FaultProfile(
+                latency_ms=args.fake_latency, jitter_ms=args.fake_jitter,
+                error_rate=args.fake_error_rate, rate_limit_rate=args.fake_429_rate,
+                retry_after=args.fake_retry_after, seed=args.fake_seed))
+            fake_server.start()
+        HttpInterceptor(cassette, fake_server.url if fake_server else None).install()
+
+    if args.load_test:
+        settings = QSettings("YandexMusicPlayer", "Settings")
+        providers = ProviderRegistry(settings)
+        names = sorted(cassette.providers - {"?"}) if args.replay else \
+            [name for name in ProviderRegistry.PROVIDERS if providers.token(name)]
+        if args.replay:
+            # Кассета не хранит секретов, любой токен подходит
+            for name in names:
+                if not providers.token(name):
+                    api = providers.create(name)
+                    if api.authenticate("replay"):
+                        providers.register(name, api)
+        report = run_load_test(providers, names, args.load_query or ["test"],
+                               args.load_test, args.load_concurrency)
+        if fake_server is not None:
+            report["server"] = fake_server.stats
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        sys.exit(0)
+
+    if args.daemon:
+        sys.exit(run_daemon(args.socket))
+
     app = QApplication(sys.argv)
     app.setQuitOnLastWindowClosed(False)
     
@@ -937,10 +4773,14 @@ def main():
         sys.exit(1)
     
     # Создать и показать главное окно
-    window = MainWindow()
+    try:
+        window = MainWindow(daemon_socket=args.socket if args.attach else None)
+    except ConnectionError as e:
+        QMessageBox.critical(None, "Демон", str(e))
+        sys.exit(1)
     window.show()
     
     sys.exit(app.exec_())
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
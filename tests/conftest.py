@@ -0,0 +1,11 @@
+"""Общие настройки тестов: main.py импортируется как модуль без окна,
+а кэши плеера пишутся во временный каталог, а не в ~/.cache."""
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+os.environ["XDG_CACHE_HOME"] = tempfile.mkdtemp(prefix="ymp-tests-")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
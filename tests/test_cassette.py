@@ -0,0 +1,112 @@
+import json
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("PyQt5.QtMultimedia", exc_type=ImportError)  # нужны и системные библиотеки Qt
+pytest.importorskip("yandex_music")
+requests = pytest.importorskip("requests")
+from yandex_music import Client
+import main
+
+SEARCH_URL = "https://api.music.yandex.net/search?text=song&type=track&page=0"
+SEARCH_BODY = {"result": {"type": "track", "text": "song", "page": 0, "perPage": 1,
+                          "searchRequestId": "test",
+                          "tracks": {"total": 1, "perPage": 1, "order": 0, "results": [
+                              {"id": "42", "title": "Song", "durationMs": 200000,
+                               "artists": [{"id": 7, "name": "Artist"}], "albums": []}]}}}
+
+
+def record(cassette, method, url, content, body=None, status=200):
+    cassette.record(method, url, body, status, {"Content-Type": "application/json", "X-Other": "1"},
+                    content.encode("utf-8"), 12.0)
+
+
+def test_secrets_are_scrubbed_and_request_headers_not_stored(tmp_path):
+    cassette = main.HttpCassette(tmp_path / "c.jsonl")
+    record(cassette, "POST", "https://ws.audioscrobbler.com/2.0/?format=json", "{}",
+           body="method=track.scrobble&api_key=KEY&sk=SESSION&artist=A")
+    saved = (tmp_path / "c.jsonl").read_text(encoding="utf-8")
+    assert "KEY" not in saved and "SESSION" not in saved
+    entry = json.loads(saved)
+    assert entry["headers"] == {"Content-Type": "application/json"}
+    assert entry["request"]["host"] == "ws.audioscrobbler.com"
+
+
+def test_exact_match_ignores_secrets_and_parameter_order(tmp_path):
+    cassette = main.HttpCassette(tmp_path / "c.jsonl")
+    record(cassette, "GET", "https://api.spotify.com/v1/search?q=a&type=track&access_token=X", "exact")
+    entry = cassette.find("GET", "https://api.spotify.com/v1/search?type=track&access_token=Y&q=a")
+    assert main.HttpCassette.content(entry) == b"exact"
+
+
+def test_route_fallback_and_round_robin(tmp_path):
+    cassette = main.HttpCassette(tmp_path / "c.jsonl")
+    record(cassette, "GET", "https://ws.audioscrobbler.com/2.0/?method=track.search&track=a", "first")
+    record(cassette, "GET", "https://ws.audioscrobbler.com/2.0/?method=track.search&track=b", "second")
+    found = [main.HttpCassette.content(cassette.find(
+        "GET", "https://ws.audioscrobbler.com/2.0/?method=track.search&track=zzz")) for _ in range(3)]
+    assert found == [b"first", b"second", b"first"]
+    assert cassette.find("GET", "https://ws.audioscrobbler.com/2.0/?method=artist.search") is None
+
+
+def test_cassette_reloads_from_disk_and_skips_torn_tail(tmp_path):
+    path = tmp_path / "c.jsonl"
+    record(main.HttpCassette(path), "GET", SEARCH_URL, "saved")
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"request": {"meth')
+    cassette = main.HttpCassette(path)
+    assert main.HttpCassette.content(cassette.find("GET", SEARCH_URL)) == b"saved"
+    assert cassette.providers == {"Yandex"}
+
+
+@pytest.fixture
+def replay(tmp_path):
+    """Фейковый сервер с кассетой поиска Яндекса и перехват HTTP в режиме воспроизведения"""
+    cassette = main.HttpCassette(tmp_path / "yandex.jsonl")
+    record(cassette, "GET", SEARCH_URL, json.dumps(SEARCH_BODY))
+    server = main.FakeProviderServer(cassette, main.FaultProfile(latency_ms=0, seed=1))
+    interceptor = main.HttpInterceptor(cassette, server.url)
+    server.start()
+    interceptor.install()
+    scheduler = main.RequestScheduler()
+    yandex = main.YandexMusicAPI()
+    yandex.client = Client("replay")   # без account/status: токен кассете не нужен
+    api = scheduler.wrap("Yandex", yandex)
+    yield server, scheduler, api
+    interceptor.uninstall()
+    server.stop()
+
+
+def test_replayed_search_goes_through_fake_server(replay):
+    server, scheduler, api = replay
+    tracks = api.search("song")
+    assert [(t.id, t.title) for t in tracks] == [("42", "Song")]
+    assert server.stats == {"Yandex": {200: 1}}
+    assert scheduler.bucket("Yandex").penalties == 0
+
+
+def test_injected_429_makes_scheduler_back_off(replay):
+    server, scheduler, api = replay
+    server.profile.rate_limit_rate = 1.0
+
+    assert api.search("song") == []
+    assert server.stats == {"Yandex": {429: 1}}
+    bucket = scheduler.bucket("Yandex")
+    assert bucket.penalties == 1
+    assert bucket.rate < bucket.base_rate
+
+    # Фоновая работа ждёт паузу после 429, интерактивный вызов — не дольше предела
+    done = threading.Event()
+
+    def background():
+        with main.RequestScheduler.priority(main.Priority.BACKGROUND):
+            scheduler.call("Yandex", done.set)
+
+    threading.Thread(target=background, daemon=True).start()
+    started = time.monotonic()
+    server.profile.rate_limit_rate = 0.0
+    assert [t.title for t in api.search("song")] == ["Song"]
+    assert time.monotonic() - started < scheduler.INTERACTIVE_MAX_WAIT_SEC + 0.5
+    assert not done.wait(1.0)
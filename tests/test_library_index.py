@@ -0,0 +1,60 @@
+import time
+
+import pytest
+
+pytest.importorskip("PyQt5.QtMultimedia", exc_type=ImportError)  # нужны и системные библиотеки Qt
+pytest.importorskip("yandex_music")
+pytest.importorskip("numpy")
+import main
+
+DAY = 86400
+
+
+def record(id_, title, artists, seconds, provider="Yandex"):
+    return {"p": provider, "i": id_, "t": title, "a": artists, "d": seconds * 1000}
+
+
+@pytest.fixture
+def index(tmp_path):
+    now = time.time()
+    history = main.PlayHistory(tmp_path / "history.jsonl")
+    history._apply("Yandex:1", now - 2 * DAY, 5)
+    history._apply("Yandex:2", now - 60 * DAY, 1)
+    history.version += 1
+    collections = {
+        "liked": {"tracks": [record("1", "Morning Song", ["Band"], 200),
+                             record("2", "Night Drive", ["Band", "Guest"], 400),
+                             record("3", "Интро", ["Другой"], 60)]},
+        "playlist:1": {"tracks": [record("2", "Night Drive", ["Band", "Guest"], 400),
+                                  record("4", "Cover", ["Band"], 180, provider="SoundCloud")]},
+    }
+    return main.LibraryIndex(collections, history)
+
+
+def titles(index, rows):
+    return [index.records[row]["t"] for row in rows]
+
+
+def test_collections_are_deduplicated(index):
+    assert len(index.records) == 4
+    assert titles(index, index.query({"collection": "playlist:1"})) == ["Night Drive", "Cover"]
+
+
+def test_duration_artist_and_title_filters(index):
+    assert titles(index, index.query({"min_duration_sec": 150, "max_duration_sec": 300})) == \
+        ["Morning Song", "Cover"]
+    assert titles(index, index.query({"artists": ["guest"]})) == ["Night Drive"]
+    assert titles(index, index.query({"exclude_artists": ["Band"]})) == ["Интро"]
+    assert titles(index, index.query({"title_contains": "DRIVE"})) == ["Night Drive"]
+    assert titles(index, index.query({"provider": "SoundCloud"})) == ["Cover"]
+    assert len(index.query({"provider": "Spotify"})) == 0
+
+
+def test_history_rules_and_sorting(index):
+    now = time.time()
+    assert titles(index, index.query({"not_played_days": 30, "collection": "liked"}, now)) == \
+        ["Night Drive", "Интро"]
+    assert titles(index, index.query({"played_days": 7}, now)) == ["Morning Song"]
+    assert titles(index, index.query({"min_plays": 1, "sort": "plays"}, now)) == \
+        ["Morning Song", "Night Drive"]
+    assert titles(index, index.query({"sort": "duration", "limit": 2}, now)) == ["Интро", "Cover"]
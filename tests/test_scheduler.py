@@ -0,0 +1,88 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("PyQt5.QtMultimedia", exc_type=ImportError)  # нужны и системные библиотеки Qt
+pytest.importorskip("yandex_music")
+from yandex_music.exceptions import BadRequestError, NetworkError
+import main
+
+
+def test_bucket_spends_burst_then_waits():
+    bucket = main.TokenBucket(rate=10.0, burst=2)
+    assert bucket.try_acquire() == 0.0
+    assert bucket.try_acquire() == 0.0
+    assert bucket.try_acquire() == pytest.approx(0.1, abs=0.02)
+
+
+def test_bucket_reserve_is_kept_for_more_important_requests():
+    bucket = main.TokenBucket(rate=1.0, burst=4)
+    assert bucket.try_acquire(reserve=2) == 0.0
+    assert bucket.try_acquire(reserve=2) == 0.0
+    assert bucket.try_acquire(reserve=2) > 0
+    assert bucket.try_acquire() == 0.0
+
+
+def test_penalty_halves_rate_blocks_and_recovers():
+    bucket = main.TokenBucket(rate=4.0, burst=4)
+    bucket.penalize(1.0)
+    assert bucket.rate == 2.0
+    assert bucket.try_acquire() == pytest.approx(1.0, abs=0.05)
+    for _ in range(100):
+        bucket.reward()
+    assert bucket.rate == 4.0
+
+
+@pytest.mark.parametrize("error, expected", [
+    (SimpleNamespace(http_status=429, headers={"Retry-After": "7"}), 7.0),
+    (SimpleNamespace(response=SimpleNamespace(status_code=429, headers={})), 5.0),
+    (SimpleNamespace(status="29"), 5.0),   # pylast
+    (NetworkError("Unknown error (429): b'{}'"), 5.0),
+    (NetworkError("Unknown error (503): b'{}'"), None),
+    (BadRequestError("bad request"), None),
+    (ValueError("boom"), None),
+])
+def test_retry_after_from_error(error, expected):
+    assert main.retry_after_from_error(error) == expected
+
+
+def test_interactive_call_does_not_wait_out_retry_after():
+    scheduler = main.RequestScheduler()
+    scheduler.penalize("Yandex", 2.0)
+    started = time.monotonic()
+    assert scheduler.call("Yandex", lambda: "ok") == "ok"
+    assert time.monotonic() - started < scheduler.INTERACTIVE_MAX_WAIT_SEC + 0.2
+
+
+def test_background_call_waits_out_retry_after():
+    scheduler = main.RequestScheduler()
+    scheduler.penalize("Yandex", 0.6)
+    started = time.monotonic()
+    with main.RequestScheduler.priority(main.Priority.BACKGROUND):
+        scheduler.call("Yandex", lambda: None)
+    assert time.monotonic() - started >= 0.55
+
+
+def test_background_yields_to_waiting_interactive_requests():
+    scheduler = main.RequestScheduler()
+    scheduler.bucket("Yandex").tokens = 0.0
+    order = []
+
+    def background():
+        with main.RequestScheduler.priority(main.Priority.BACKGROUND):
+            scheduler.call("Yandex", order.append, "background")
+
+    thread = threading.Thread(target=background)
+    thread.start()
+    time.sleep(0.05)
+    scheduler.call("Yandex", order.append, "interactive")
+    thread.join(5)
+    assert order == ["interactive", "background"]
+
+
+def test_unlimited_provider_is_not_scheduled():
+    scheduler = main.RequestScheduler()
+    assert scheduler.bucket("Local") is None
+    assert scheduler.call("Local", lambda: 1) == 1
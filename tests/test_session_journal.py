@@ -0,0 +1,50 @@
+import pytest
+
+pytest.importorskip("PyQt5.QtMultimedia", exc_type=ImportError)  # нужны и системные библиотеки Qt
+pytest.importorskip("yandex_music")
+import main
+
+QUEUE = [{"p": "Yandex", "i": "1", "t": "Первая", "a": ["A"], "d": 200000},
+         {"p": "Yandex", "i": "2", "t": "Вторая", "a": ["B"], "d": 180000}]
+
+
+def _journal(path):
+    journal = main.SessionJournal(path)
+    queue = [main.SnapshotTrack(record) for record in QUEUE]
+    journal.set_lists(queue, queue)
+    journal.set_position(1, 42000)
+    journal._file.close()
+    return journal
+
+
+def test_journal_round_trip(tmp_path):
+    _journal(tmp_path / "session.bin")
+    state = main.SessionJournal(tmp_path / "session.bin").load()
+    assert state["queue"] == QUEUE
+    assert state["visible"] is None
+    assert (state["index"], state["position_ms"]) == (1, 42000)
+
+
+@pytest.mark.parametrize("cut", [1, main.SessionJournal.RECORD.size - 1, main.SessionJournal.RECORD.size + 3])
+def test_torn_tail_is_dropped_and_rewritten(tmp_path, cut):
+    path = tmp_path / "session.bin"
+    _journal(path)
+    good = path.read_bytes()
+    # Оборванная при сбое запись о позиции, в том числе короче заголовка записи
+    payload = main.SessionJournal.POSITION.pack(0, 1000)
+    torn = main.SessionJournal.RECORD.pack(len(payload), main.SessionJournal.REC_POSITION, 0) + payload
+    path.write_bytes(good + torn[:cut])
+
+    journal = main.SessionJournal(path)
+    assert journal.load()["position_ms"] == 42000
+    assert journal._broken
+
+    journal.set_position(0, 5000)
+    journal._file.close()
+    assert main.SessionJournal(path).load()["position_ms"] == 5000
+
+
+def test_unknown_format_starts_over(tmp_path):
+    path = tmp_path / "session.bin"
+    path.write_bytes(b"garbage")
+    assert main.SessionJournal(path).load()["queue"] == []
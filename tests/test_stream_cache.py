@@ -0,0 +1,75 @@
+import os
+import time
+
+import pytest
+
+pytest.importorskip("PyQt5.QtMultimedia", exc_type=ImportError)  # нужны и системные библиотеки Qt
+pytest.importorskip("yandex_music")
+import main
+
+
+def test_range_set_merges_overlapping_and_adjacent():
+    ranges = main.RangeSet([[10, 20], [30, 40]])
+    ranges.add(20, 25)
+    ranges.add(35, 50)
+    assert ranges.ranges == [[10, 25], [30, 50]]
+    ranges.add(0, 100)
+    assert ranges.ranges == [[0, 100]]
+
+
+def test_range_set_contiguous_end_and_next_gap():
+    ranges = main.RangeSet([[0, 10], [20, 30]])
+    assert ranges.contiguous_end(5) == 10
+    assert ranges.contiguous_end(15) == 15
+    assert ranges.next_gap(0, 40) == 10
+    assert ranges.next_gap(25, 40) == 30
+    assert ranges.next_gap(25, 30) == 10   # после конца — пропуск с начала файла
+    assert main.RangeSet([[0, 30]]).next_gap(0, 30) is None
+
+
+def _write(path, size, age):
+    path.write_bytes(os.urandom(size))
+    stamp = time.time() - age
+    os.utime(path, (stamp, stamp))
+
+
+def test_audio_cache_evicts_oldest_complete_and_partial_files(tmp_path):
+    mb = 1024 * 1024
+    cache = main.AudioCache(tmp_path, max_bytes=2 * mb + 64 * 1024)
+    for key, age in (("Yandex:old", 300), ("Yandex:new", 10)):
+        data, meta = cache.partial(key)
+        _write(data, mb, age)
+        _write(meta, 10, age)
+    _write(tmp_path / (cache.file_name("Yandex:done") + ".mp3"), mb, 100)
+
+    cache.evict()
+
+    assert not cache.partial("Yandex:old")[0].exists()
+    assert not cache.partial("Yandex:old")[1].exists()   # .json уходит вместе с .part
+    assert cache.partial("Yandex:new")[0].exists()
+    assert cache.complete("Yandex:done") is not None
+
+
+def test_audio_cache_keeps_active_downloads(tmp_path):
+    mb = 1024 * 1024
+    cache = main.AudioCache(tmp_path, max_bytes=mb)
+    data, _ = cache.partial("Yandex:playing")
+    _write(data, 2 * mb, 1000)
+    _write(tmp_path / (cache.file_name("Yandex:done") + ".mp3"), mb, 10)
+    cache.set_active("Yandex:playing", True)
+
+    cache.evict()
+
+    assert data.exists()
+    assert cache.complete("Yandex:done") is None
+
+
+def test_audio_cache_counts_sparse_partials_by_allocated_size(tmp_path):
+    cache = main.AudioCache(tmp_path, max_bytes=1024 * 1024)
+    data, _ = cache.partial("Yandex:sparse")
+    with open(data, "wb") as f:
+        f.truncate(100 * 1024 * 1024)   # длина 100 МБ, на диске почти ничего
+
+    cache.evict()
+
+    assert data.exists()
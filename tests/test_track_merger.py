@@ -0,0 +1,50 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("PyQt5.QtMultimedia", exc_type=ImportError)  # нужны и системные библиотеки Qt
+pytest.importorskip("yandex_music")
+import main
+
+
+def track(title, artist, seconds, id_=None):
+    return SimpleNamespace(id=id_ or f"{artist}-{title}-{seconds}", title=title,
+                           artists=[SimpleNamespace(name=artist)], duration_ms=seconds * 1000)
+
+
+def lastfm(title, artist, seconds=0):
+    return main.LastFmTrack(SimpleNamespace(get_mbid=lambda: None, title=title,
+                                            get_duration=lambda: seconds * 1000,
+                                            artist=SimpleNamespace(name=artist)))
+
+
+def merge(*batches):
+    merger = main.TrackMerger()
+    for batch in batches:
+        merger.add(batch)
+    return merger.tracks
+
+
+def test_duplicates_merge_within_tolerance():
+    tracks = merge([track("Song (Remastered)", "Artist", 200)], [track("song", "artist", 202)])
+    assert len(tracks) == 1
+
+
+def test_different_lengths_stay_separate():
+    assert len(merge([track("Song", "Artist", 200)], [track("Song", "Artist", 320)])) == 2
+
+
+def test_playable_version_replaces_lastfm_metadata():
+    merger = main.TrackMerger()
+    merger.add([lastfm("Song", "Artist", 200)])
+    playable = track("Song", "Artist", 201)
+    added, replaced = merger.add([playable])
+    assert added == [] and replaced == [(0, playable)]
+
+
+def test_durationless_result_merges_the_same_in_any_order():
+    untimed = lastfm("Song", "Artist")
+    short, long = track("Song", "Artist", 200), track("Song", "Artist", 320)
+    for batches in ([[untimed], [short], [long]], [[short], [untimed], [long]],
+                    [[short], [long], [untimed]]):
+        assert len(merge(*batches)) == 2, batches